@@ -31,5 +31,17 @@ def classFactory(iface):  # pylint: disable=invalid-name
     :type iface: QgsInterface
     """
     #
+    import os
+    from qgis.PyQt.QtCore import QSettings
+    from .gridcache import CACHE_SIZE_ENV, GRID_DIR_ENV
+
+    # A shared grid directory and its size limit can be set in the QGIS settings, as well as in
+    # the environment. They need to be known before the transforms are built.
+    settings = QSettings()
+    for key, variable in (('icsm_ntv2_transformer/grid_dir', GRID_DIR_ENV), ('icsm_ntv2_transformer/grid_cache_mb', CACHE_SIZE_ENV)):
+        value = settings.value(key, '')
+        if value and not os.environ.get(variable):
+            os.environ[variable] = str(value)
+
     from .icsm_qgis_transformer import icsm_ntv2_transformer
     return icsm_ntv2_transformer(iface)
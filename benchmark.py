@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ benchmark
+                                 A QGIS plugin
+ This plugin uses official ICSM grids to transform between Australian coordinate systems.
+                              -------------------
+        begin                : 2017-01-08
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Alex Leith
+        email                : alex@auspatious.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+ Benchmarks of every transform path, on synthetic data so they run offline.
+
+ A small synthetic NTv2 grid is written, and point, line, polygon and raster
+ datasets are generated in each source coordinate system. The registry, file
+ probe, grid loading and transformations are timed and appended to a JSON
+ history, and each result is compared with the previous runs. From the
+ directory holding the plugin:
+
+     python -m icsm_ntv2_transformer.benchmark --features 100000 --history benchmarks.json
+
+ Stages that need QGIS are skipped when it isn't available. The exit code is
+ 1 when a stage got slower than the threshold allows.
+"""
+
+import argparse
+import json
+import os
+import os.path
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from .coordinates import CoordinateSystem, transform_coordinates
+from .ntv2 import SubGrid, close_grids, open_grid, write_grid
+from .transforms import source_zone, supported_transforms, transforms_for, with_grid
+
+# Source CRSs benchmarked by default, one zone of each projected system and each geographic one
+SOURCES = ['EPSG:20255', 'EPSG:20355', 'EPSG:28355', 'EPSG:7855', 'EPSG:4202', 'EPSG:4203', 'EPSG:4283', 'EPSG:7844']
+GEOMETRIES = ['point', 'line', 'polygon']
+
+# A stage is a regression when it's slower than the median of the recent runs by this factor...
+THRESHOLD = 1.25
+# ...and by at least this many seconds, so tiny stages don't flap
+MIN_REGRESSION = 0.05
+# Number of earlier runs to compare against
+HISTORY_WINDOW = 5
+
+# Extent of the synthetic data and grid, in degrees
+WEST, SOUTH, EAST, NORTH = 108.0, -45.0, 156.0, -9.0
+
+
+def synthetic_grid(path, spacing=0.25):
+    """Write an NTv2 grid over Australia with smooth shifts of about a metre, and a finer child subgrid.
+
+    The shifts are made up, but the shape of the file is the same as the real grids.
+    """
+    def subgrid(name, parent, west, south, east, north, step):
+        s_lat, n_lat, e_long, w_long = south * 3600.0, north * 3600.0, -east * 3600.0, -west * 3600.0
+        inc = step * 3600.0
+        rows = int(round((n_lat - s_lat) / inc)) + 1
+        cols = int(round((w_long - e_long) / inc)) + 1
+        lat = (s_lat + np.arange(rows) * inc)[:, None] / 3600.0
+        lon = -(e_long + np.arange(cols) * inc)[None, :] / 3600.0
+        data = np.zeros((rows, cols, 4), dtype=np.float32)
+        data[:, :, 0] = 0.03 + 0.01 * np.sin(np.radians(lon * 7.0)) * np.cos(np.radians(lat * 5.0))
+        data[:, :, 1] = -0.04 + 0.01 * np.cos(np.radians(lon * 3.0)) * np.sin(np.radians(lat * 11.0))
+        data[:, :, 2:] = 0.01
+        return SubGrid(name, parent, '', '', s_lat, n_lat, e_long, w_long, inc, inc, rows * cols, data.ravel())
+
+    subgrids = [
+        subgrid('AUS', 'NONE', WEST, SOUTH, EAST, NORTH, spacing),
+        subgrid('SYD', 'AUS', 150.0, -35.0, 152.0, -33.0, spacing / 10.0),
+    ]
+    return write_grid(path, subgrids, 'SYNTH_F', 'SYNTH_T')
+
+
+def random_lonlat(transform, count, rng):
+    """Random lon/lat inside the source zone of a transform, or over the whole grid if it isn't projected."""
+    zone = source_zone(transform)
+    if zone:
+        west, east = zone * 6.0 - 186.0, zone * 6.0 - 180.0
+    else:
+        west, east = WEST + 1.0, EAST - 1.0
+    return rng.uniform(west, east, count), rng.uniform(SOUTH + 1.0, NORTH - 1.0, count)
+
+
+def write_vector(path, transform, geometry, count, rng):
+    """Write count random features of a geometry type, in the source CRS of a transform."""
+    from osgeo import ogr, osr
+
+    source = CoordinateSystem(transform.source_proj)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(transform.source_code)
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+    # Lines and polygons get a few vertices around each random centre
+    vertices = {'point': 1, 'line': 8, 'polygon': 12}[geometry]
+    lon, lat = random_lonlat(transform, count, rng)
+    angles = np.linspace(0.0, 2.0 * np.pi, vertices, endpoint=False)
+    lon = lon[:, None] + 0.01 * np.cos(angles)[None, :]
+    lat = lat[:, None] + 0.01 * np.sin(angles)[None, :]
+    x, y = source.from_lonlat(lon.ravel(), lat.ravel())
+    x = x.reshape(count, vertices)
+    y = y.reshape(count, vertices)
+
+    dataset = ogr.GetDriverByName('GPKG').CreateDataSource(path)
+    geometry_type = {'point': ogr.wkbPoint, 'line': ogr.wkbLineString, 'polygon': ogr.wkbPolygon}[geometry]
+    layer = dataset.CreateLayer(geometry, srs, geometry_type)
+    layer.CreateField(ogr.FieldDefn('name', ogr.OFTString))
+    layer.CreateField(ogr.FieldDefn('value', ogr.OFTReal))
+    layer_defn = layer.GetLayerDefn()
+    dataset.StartTransaction()
+    for i in range(count):
+        feature = ogr.Feature(layer_defn)
+        feature.SetField(0, 'feature {}'.format(i))
+        feature.SetField(1, float(i))
+        if geometry == 'point':
+            wkt = 'POINT ({} {})'.format(x[i, 0], y[i, 0])
+        else:
+            ring = list(zip(x[i], y[i]))
+            if geometry == 'polygon':
+                ring.append(ring[0])
+            coordinates = ', '.join('{} {}'.format(*vertex) for vertex in ring)
+            wkt = 'LINESTRING ({})'.format(coordinates) if geometry == 'line' else 'POLYGON (({}))'.format(coordinates)
+        feature.SetGeometryDirectly(ogr.CreateGeometryFromWkt(wkt))
+        layer.CreateFeature(feature)
+    dataset.CommitTransaction()
+    dataset = None
+    return path
+
+
+def write_raster(path, transform, size, rng):
+    """Write a square single band raster of random bytes, in the source CRS of a transform."""
+    from osgeo import gdal, osr
+
+    source = CoordinateSystem(transform.source_proj)
+    lon, lat = random_lonlat(transform, 1, rng)
+    x, y = source.from_lonlat(lon, lat)
+    pixel = 25.0 if source_zone(transform) else 0.00025
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(transform.source_code)
+
+    dataset = gdal.GetDriverByName('GTiff').Create(path, size, size, 1, gdal.GDT_Byte, ['TILED=YES'])
+    dataset.SetGeoTransform((float(x[0]), pixel, 0.0, float(y[0]), 0.0, -pixel))
+    dataset.SetProjection(srs.ExportToWkt())
+    dataset.GetRasterBand(1).WriteArray(rng.integers(0, 255, (size, size), dtype=np.uint8))
+    dataset = None
+    return path
+
+
+class Timings(object):
+    """Times stages over several repeats, keeping the count of things each one processed."""
+
+    def __init__(self, repeat=3):
+        self.repeat = repeat
+        self.results = {}
+
+    def run(self, name, function, count=None, setup=None):
+        seconds = []
+        for __ in range(self.repeat):
+            if setup:
+                setup()
+            start = time.perf_counter()
+            function()
+            seconds.append(time.perf_counter() - start)
+        self.results[name] = {
+            'min': min(seconds),
+            'median': statistics.median(seconds),
+            'count': count,
+        }
+        print("{:40} {:>9.4f}s {:>9.4f}s {}".format(name, min(seconds), statistics.median(seconds), count or ''))
+
+    def skip(self, name, reason):
+        self.results[name] = {'skipped': reason}
+        print("{:40} skipped, {}".format(name, reason))
+
+
+def init_qgis():
+    """Start a headless QGIS application, or return None if QGIS isn't available."""
+    try:
+        from qgis.core import QgsApplication
+    except ImportError:
+        return None
+    qgs = QgsApplication([], False)
+    qgs.initQgis()
+    return qgs
+
+
+def run_benchmarks(work_dir, sources, features, raster_size, repeat=3, seed=0):
+    rng = np.random.default_rng(seed)
+    timings = Timings(repeat)
+    grid = synthetic_grid(os.path.join(work_dir, 'synthetic.gsb'))
+
+    timings.run('registry', lambda: supported_transforms(), setup=supported_transforms.cache_clear,
+                count=sum(len(t) for t in supported_transforms().values()))
+    timings.run('grid_load', lambda: open_grid(grid).interpolate([151.0], [-34.0]), setup=close_grids)
+    # Its own random points, so the ones used below don't change
+    grid_rng = np.random.default_rng(seed)
+    lon, lat = grid_rng.uniform(WEST + 1.0, EAST - 1.0, features), grid_rng.uniform(SOUTH + 1.0, NORTH - 1.0, features)
+    timings.run('grid_inverse', lambda: open_grid(grid).inverse(lon, lat), count=features)
+
+    qgs = init_qgis()
+    for authid in sources:
+        transforms = transforms_for(authid)
+        if not transforms:
+            timings.skip(authid, "not a supported source")
+            continue
+        transform = with_grid(transforms[0], grid)
+        key = authid.replace('EPSG:', '')
+
+        lon, lat = random_lonlat(transform, features, rng)
+        x, y = CoordinateSystem(transform.source_proj).from_lonlat(lon, lat)
+        timings.run('{}/coordinates'.format(key), lambda: transform_coordinates(transform, x, y), count=features)
+
+        if qgs is None:
+            for stage in ['probe'] + GEOMETRIES + ['raster']:
+                timings.skip('{}/{}'.format(key, stage), "QGIS isn't available")
+            continue
+
+        files = dict((geometry, write_vector(os.path.join(work_dir, '{}_{}.gpkg'.format(key, geometry)), transform, geometry, features, rng))
+                     for geometry in GEOMETRIES)
+        files['raster'] = write_raster(os.path.join(work_dir, '{}_raster.tif'.format(key)), transform, raster_size, rng)
+
+        from .engine import open_input, transform_raster_file
+        from .vectors import transform_vector_file
+        from . import probe
+
+        timings.run('{}/probe'.format(key), lambda: probe.probe_file(files['point']), setup=probe._cache.clear)
+        for geometry in GEOMETRIES:
+            out_file = os.path.join(work_dir, '{}_{}_out.gpkg'.format(key, geometry))
+            timings.run('{}/{}'.format(key, geometry),
+                        lambda: transform_vector_file(transform, open_input(files[geometry])[1], out_file), count=features)
+        out_file = os.path.join(work_dir, '{}_raster_out.tif'.format(key))
+        timings.run('{}/raster'.format(key),
+                    lambda: transform_raster_file(transform, open_input(files['raster'])[1], out_file), count=raster_size * raster_size)
+
+    close_grids()
+    if qgs is not None:
+        qgs.exitQgis()
+    return timings.results
+
+
+def regressions(results, history, threshold=THRESHOLD, min_regression=MIN_REGRESSION, window=HISTORY_WINDOW):
+    """The stages that are slower than the median of the last window runs, as a list of messages.
+
+    history should only hold runs with the same parameters.
+    """
+    messages = []
+    for name, result in sorted(results.items()):
+        if 'median' not in result:
+            continue
+        previous = [run['results'][name]['median'] for run in history[-window:]
+                    if 'median' in run['results'].get(name, {})]
+        if not previous:
+            continue
+        baseline = statistics.median(previous)
+        if result['median'] > baseline * threshold and result['median'] - baseline > min_regression:
+            messages.append("{} took {:.3f}s, up from {:.3f}s".format(name, result['median'], baseline))
+    return messages
+
+
+def plugin_version():
+    try:
+        with open(os.path.join(os.path.dirname(__file__), 'metadata.txt')) as f:
+            for line in f:
+                if line.startswith('version='):
+                    return line.split('=', 1)[1].strip()
+    except OSError:
+        pass
+    return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the transformer on synthetic data.")
+    parser.add_argument('--features', type=int, default=10000, help="Features in each vector dataset (default: %(default)s)")
+    parser.add_argument('--raster-size', type=int, default=2048, help="Width and height of each raster (default: %(default)s)")
+    parser.add_argument('--sources', nargs='+', default=SOURCES, help="Source CRS authids to benchmark")
+    parser.add_argument('--repeat', type=int, default=3, help="Times to run each stage (default: %(default)s)")
+    parser.add_argument('--history', help="JSON file to compare with and append the results to")
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help="Slowdown factor that counts as a regression (default: %(default)s)")
+    parser.add_argument('--keep', help="Keep the generated data in this directory")
+    args = parser.parse_args(argv)
+
+    work_dir = args.keep or tempfile.mkdtemp(prefix='icsm_benchmark_')
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    try:
+        results = run_benchmarks(work_dir, args.sources, args.features, args.raster_size, args.repeat)
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if not args.history:
+        return 0
+
+    history = []
+    if os.path.isfile(args.history):
+        with open(args.history) as f:
+            history = json.load(f)
+    parameters = {'features': args.features, 'raster_size': args.raster_size, 'repeat': args.repeat}
+    messages = regressions(results, [run for run in history if run.get('parameters') == parameters], args.threshold)
+    history.append({
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'version': plugin_version(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': parameters,
+        'results': results,
+        'regressions': messages,
+    })
+    with open(args.history, 'w') as f:
+        json.dump(history, f, indent=2)
+
+    for message in messages:
+        print("Regression: {}".format(message), file=sys.stderr)
+    return 1 if messages else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
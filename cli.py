@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ cli
+                                 A QGIS plugin
+ This plugin uses official ICSM grids to transform between Australian coordinate systems.
+                              -------------------
+        begin                : 2017-01-08
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Alex Leith
+        email                : alex@auspatious.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+ Headless batch transformation of many files, run from a shell that has the
+ QGIS Python environment set up. From the directory holding the plugin:
+
+     python -m icsm_ntv2_transformer.cli --target 78d --workers 8 /data/tiles/*.tif
+
+ Run with --list-targets to see the available targets.
+"""
+
+import argparse
+import csv
+import glob
+import json
+import multiprocessing
+import os
+import os.path
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .engine import (DEFAULT_WARP, QA_POINTS, QA_TOLERANCE, RASTER_FORMATS, RESAMPLING_METHODS, VECTOR_FORMATS,
+                     TransformError, WarpSettings, check_round_trip, crop_transform, dataset_extent, log, open_input, prefetch_grids,
+                     transform_raster_by_zone, transform_raster_file)
+from .timing import Timer, write_metrics
+from .transforms import available_epsgs, supported_transforms, target_datum, transforms_for
+from .vectors import STREAM_BATCH_SIZE, stream_vector_file, transform_vector_by_zone, transform_vector_file
+
+REPORT_FIELDS = ['in_file', 'out_file', 'status', 'source', 'target', 'seconds', 'qa_max', 'qa_failed', 'message']
+
+# The QGIS application for each worker process
+_QGS = None
+
+
+def transform_matches(transform, target):
+    """Whether a Transform goes to the target, which is a key of available_epsgs such as '78d'."""
+    return target_datum(transform) == available_epsgs[target]['name']
+
+
+def find_transform(source_crs, target):
+    for transform in transforms_for(source_crs):
+        if transform_matches(transform, target):
+            return transform
+    return None
+
+
+def required_grids(target):
+    grids = set()
+    for transforms in supported_transforms().values():
+        for transform in transforms:
+            if transform.grid and transform_matches(transform, target):
+                grids.add(transform.grid)
+    return sorted(grids)
+
+
+def find_inputs(inputs, recursive=False):
+    """Expand files, directories and glob patterns into a sorted list of files."""
+    files = set()
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            if recursive:
+                for root, __, names in os.walk(pattern):
+                    files.update(os.path.join(root, name) for name in names)
+            else:
+                files.update(os.path.join(pattern, name) for name in os.listdir(pattern))
+        else:
+            files.update(glob.glob(pattern, recursive=recursive))
+    return sorted(f for f in files if os.path.isfile(f))
+
+
+def out_file_name(in_file, in_file_type, out_dir=None, vector_format='shp', raster_format='tif'):
+    filename = os.path.splitext(os.path.basename(in_file))[0] + '_transformed'
+    if in_file_type == 'VECTOR':
+        filename += VECTOR_FORMATS[vector_format].extension
+    else:
+        filename += RASTER_FORMATS[raster_format].extension
+    return os.path.join(out_dir or os.path.dirname(in_file), filename)
+
+
+def init_worker(verbose=False):
+    global _QGS
+    from qgis.core import QgsApplication
+    _QGS = QgsApplication([], False)
+    _QGS.initQgis()
+    if verbose:
+        QgsApplication.messageLog().messageReceived.connect(
+            lambda message, tag, level: sys.stderr.write("[{}] {}\n".format(os.getpid(), message)))
+
+
+def transform_file(in_file, target, out_dir=None, warp_threads=1, by_zone=False, merge_zones=False, zone_threads=1,
+                   vector_format='shp', raster_format='tif', timings_dir=None, crop=True, qa_points=QA_POINTS,
+                   qa_tolerance=QA_TOLERANCE, warp=DEFAULT_WARP, stream_batch=0):
+    """Transform a single file, returning a row for the report. This runs in a worker process.
+
+    With by_zone, features and rasters are written in the zone they fall in, and the zones of
+    a vector file are transformed on zone_threads threads. The totals for each stage are in the
+    row's 'stages', and all of the timings are written to timings_dir if it's given. With crop,
+    only an extract of the grid covering the file is used. Afterwards qa_points points over the
+    file are sent through the transform and back, and if any come back further away than
+    qa_tolerance metres the status is QA_FAILED, with the worst of them in the row's 'qa'.
+    Rasters are warped with the WarpSettings warp. With stream_batch, vector files are read and
+    written that many features at a time, and resume from where they stopped if they're run again.
+    """
+    start = time.time()
+    row = dict((field, '') for field in REPORT_FIELDS)
+    row['in_file'] = in_file
+    timer = Timer(in_file, on_span=lambda span: log("{}: {}".format(in_file, span)))
+    try:
+        in_file_type, dataset, source_crs = open_input(in_file, timer)
+        row['source'] = source_crs
+        transform = find_transform(source_crs, target)
+        if transform is None:
+            raise TransformError("No transformation from {} to {}".format(source_crs, target))
+        row['target'] = 'EPSG:{}'.format(transform.target_code)
+        extent = dataset_extent(in_file_type, dataset)
+        if crop:
+            transform = crop_transform(transform, extent, timer)
+
+        out_file = out_file_name(in_file, in_file_type, out_dir, vector_format, raster_format)
+        if stream_batch and in_file_type == 'VECTOR':
+            out_files = [stream_vector_file(transform, in_file, out_file, out_format=vector_format, batch_size=stream_batch,
+                                            timer=timer)]
+        elif by_zone and in_file_type == 'VECTOR':
+            out_files = transform_vector_by_zone(transform, dataset, out_file, merge=merge_zones, workers=zone_threads,
+                                                 out_format=vector_format, timer=timer)
+        elif by_zone:
+            out_files = transform_raster_by_zone(transform, dataset, out_file, threads=warp_threads, out_format=raster_format,
+                                                 timer=timer, warp=warp)
+        elif in_file_type == 'VECTOR':
+            out_files = [transform_vector_file(transform, dataset, out_file, out_format=vector_format, timer=timer)]
+        else:
+            out_files = [transform_raster_file(transform, dataset, out_file, threads=warp_threads, out_format=raster_format,
+                                               timer=timer, warp=warp)]
+        dataset = None
+        row['out_file'] = ';'.join(out_files)
+        row['status'] = 'OK'
+
+        qa = check_round_trip(transform, extent, qa_points, qa_tolerance, in_file, timer)
+        if qa and qa.max is not None:
+            row['qa_max'] = qa.max
+            row['qa_failed'] = qa.failed
+            row['qa'] = qa._asdict()
+            if qa.failed:
+                row['status'] = 'QA_FAILED'
+                row['message'] = "{} of {} points came back over {} m away".format(qa.failed, qa.points, qa.tolerance)
+    except TransformError as e:
+        row['status'] = 'FAILED'
+        row['message'] = str(e)
+    except Exception as e:
+        # Keep going with the rest of the batch, whatever went wrong
+        log("Unexpected error transforming {}: {}".format(in_file, e), True)
+        row['status'] = 'FAILED'
+        row['message'] = "Unexpected error: {}".format(e)
+    row['seconds'] = round(time.time() - start, 3)
+    row['stages'] = timer.totals()
+    if timings_dir:
+        timer.write_json(os.path.join(timings_dir, os.path.splitext(os.path.basename(in_file))[0] + '.timings.json'))
+    return row
+
+
+def write_report(rows, report_file):
+    if report_file.lower().endswith('.json'):
+        with open(report_file, 'w') as f:
+            json.dump(rows, f, indent=2)
+    else:
+        with open(report_file, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+def run_batch(files, target, out_dir=None, workers=None, warp_threads=1, verbose=False, by_zone=False, merge_zones=False,
+              vector_format='shp', raster_format='tif', timings_dir=None, crop=True, qa_points=QA_POINTS,
+              qa_tolerance=QA_TOLERANCE, warp=DEFAULT_WARP, stream_batch=0):
+    """Transform files in parallel, yielding a report row for each as it finishes.
+
+    Grids are memory mapped, so workers using the same grid or extract share its pages through
+    the page cache rather than each loading a copy.
+    """
+    # Download grids up front, so workers don't race each other to fetch them.
+    if not prefetch_grids(required_grids(target)):
+        raise TransformError("Failed to download the transformation grids")
+
+    # When there are fewer files than workers, share the spare cores out between the zones of each file
+    zone_threads = max(1, (workers or os.cpu_count() or 1) // max(len(files), 1))
+
+    # Spawn rather than fork, so every worker gets a clean QGIS application.
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker, initargs=(verbose,)) as executor:
+        futures = [executor.submit(transform_file, in_file, target, out_dir, warp_threads, by_zone, merge_zones, zone_threads,
+                                   vector_format, raster_format, timings_dir, crop, qa_points, qa_tolerance, warp,
+                                   stream_batch)
+                   for in_file in files]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Transform files between Australian coordinate systems using ICSM NTv2 grids.")
+    parser.add_argument('inputs', nargs='*', help="Input files, directories or glob patterns")
+    parser.add_argument('-t', '--target', help="Target coordinate system, such as 78d or 4283 (see --list-targets)")
+    parser.add_argument('-o', '--out-dir', help="Directory for outputs, defaults to next to each input")
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help="Number of worker processes (default: %(default)s)")
+    parser.add_argument('--warp-threads', default='1', help="Threads used by each worker to warp a raster, or ALL_CPUS (default: %(default)s)")
+    parser.add_argument('--vector-format', choices=list(VECTOR_FORMATS),
+                        help="Output format for vector files (default: shp, or gpkg with --stream)")
+    parser.add_argument('--raster-format', choices=list(RASTER_FORMATS), default='tif',
+                        help="Output format for rasters, a tiled GeoTIFF or a Cloud Optimised GeoTIFF (default: %(default)s)")
+    parser.add_argument('--resampling', choices=list(RESAMPLING_METHODS), default=DEFAULT_WARP.resampling,
+                        help="Resampling method for rasters (default: %(default)s)")
+    parser.add_argument('--error-threshold', type=float, default=DEFAULT_WARP.error_threshold,
+                        help="Largest error allowed when approximating the transformation of a raster, in pixels (default: %(default)s)")
+    parser.add_argument('--mesh', action='store_true',
+                        help="Work out the transformation of each raster on a coarse mesh first, and interpolate it for every pixel")
+    parser.add_argument('--shift', action='store_true',
+                        help="Copy rasters that the transformation moves evenly, to within the error threshold, with their origin moved instead of warping them")
+    parser.add_argument('-z', '--by-zone', action='store_true',
+                        help="Write features and raster tiles in the MGA/AMG zone they fall in, with an output for each zone")
+    parser.add_argument('--merge-zones', action='store_true', help="With --by-zone, gather the zones of each vector file into one GeoPackage")
+    parser.add_argument('--stream', action='store_true',
+                        help="Read and write vector files a batch at a time in constant memory, resuming any that were interrupted")
+    parser.add_argument('--batch-size', type=int, default=STREAM_BATCH_SIZE,
+                        help="Features in each batch and transaction with --stream (default: %(default)s)")
+    parser.add_argument('--full-grid', action='store_true',
+                        help="Use the whole grid, rather than an extract covering each file")
+    parser.add_argument('--qa-points', type=int, default=QA_POINTS,
+                        help="Points sent through the transform and back to check each file, or 0 to skip the check (default: %(default)s)")
+    parser.add_argument('--qa-tolerance', type=float, default=QA_TOLERANCE,
+                        help="Largest distance in metres a checked point may come back from where it started (default: %(default)s)")
+    parser.add_argument('-r', '--recursive', action='store_true', help="Search directories and ** patterns recursively")
+    parser.add_argument('--report', help="Write the per file summary to this .csv or .json file")
+    parser.add_argument('--timings', help="Directory to write the timings of each stage of each file to, as JSON")
+    parser.add_argument('--metrics', help="Write the stage totals of every file to this Prometheus text format file")
+    parser.add_argument('--list-targets', action='store_true', help="List the available targets and exit")
+    parser.add_argument('-v', '--verbose', action='store_true', help="Print the transformer log")
+    args = parser.parse_args(argv)
+
+    if args.list_targets:
+        for key, info in available_epsgs.items():
+            print("{:8}{}".format(key, info['name']))
+        return 0
+
+    if args.target not in available_epsgs:
+        parser.error("--target must be one of: {}".format(', '.join(available_epsgs)))
+    if args.stream and args.by_zone:
+        parser.error("--stream can't be used with --by-zone")
+    vector_format = args.vector_format or ('gpkg' if args.stream else 'shp')
+    files = find_inputs(args.inputs, args.recursive)
+    if not files:
+        parser.error("No input files found")
+    for directory in (args.out_dir, args.timings):
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    rows = []
+    start = time.time()
+    try:
+        for row in run_batch(files, args.target, args.out_dir, args.workers, args.warp_threads, args.verbose,
+                             args.by_zone, args.merge_zones, vector_format, args.raster_format, args.timings,
+                             not args.full_grid, args.qa_points, args.qa_tolerance,
+                             WarpSettings(args.resampling, args.error_threshold, args.mesh, args.shift),
+                             args.batch_size if args.stream else 0):
+            rows.append(row)
+            print("[{}/{}] {:6} {:>8.1f}s  {}  {}".format(
+                len(rows), len(files), row['status'], row['seconds'], row['in_file'], row['message'] or row['out_file']))
+    except TransformError as e:
+        print("Error: {}".format(e), file=sys.stderr)
+        return 2
+
+    failed = [row for row in rows if row['status'] != 'OK']
+    print("Transformed {} of {} files in {:.1f}s, {} failed.".format(
+        len(rows) - len(failed), len(rows), time.time() - start, len(failed)))
+    if args.report:
+        rows.sort(key=lambda row: row['in_file'])
+        write_report(rows, args.report)
+    if args.metrics:
+        write_metrics(args.metrics, dict((row['in_file'], row['stages']) for row in rows))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ coordinates
+                                 A QGIS plugin
+ This plugin uses official ICSM grids to transform between Australian coordinate systems.
+                              -------------------
+        begin                : 2017-01-08
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Alex Leith
+        email                : alex@auspatious.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+ Vectorised transformation of coordinate arrays for a Transform.
+
+ Coordinates are unprojected from UTM (when needed), shifted with the
+ transform's NTv2 grid and projected again, all on whole NumPy arrays.
+ Nothing here needs QGIS, so it can be used for batch work outside of it.
+"""
+
+import math
+from functools import lru_cache
+
+import numpy as np
+
+from .ntv2 import open_grid
+from .transforms import available_zones
+
+# Ellipsoids used by the proj strings, as (semi-major axis, inverse flattening)
+ELLIPSOIDS = {
+    'GRS80': (6378137.0, 298.257222101),
+    'aust_SA': (6378160.0, 298.25),
+}
+
+UTM_SCALE_FACTOR = 0.9996
+UTM_FALSE_EASTING = 500000.0
+UTM_FALSE_NORTHING = 10000000.0
+
+# Coarsest spacing of a warp mesh, in pixels. Meshes are made finer from here until they're accurate enough.
+MESH_STEP = 256
+# Each cell of a warp mesh is checked on a lattice this many divisions across and down
+MESH_CHECKS = 4
+# Cells each way in the lattice a raster is sampled on, to see if it can just be shifted
+SHIFT_SAMPLES = 16
+
+
+def utm_zone(lon):
+    """The UTM zone of each longitude, limited to the zones used in Australia."""
+    zone = np.floor((np.asarray(lon, dtype=np.float64) + 180.0) / 6.0).astype(np.int64) + 1
+    return np.clip(zone, available_zones[0], available_zones[-1])
+
+
+def parse_proj(proj):
+    """Split a proj string into a dict of its '+key=value' parameters."""
+    params = {}
+    for part in (proj or '').split():
+        key, __, value = part.lstrip('+').partition('=')
+        params[key] = value
+    return params
+
+
+class TransverseMercator(object):
+    """UTM projection on an ellipsoid, using the Krüger series (accurate to well under a millimetre within a zone)."""
+
+    def __init__(self, ellipsoid, zone):
+        a, inverse_flattening = ELLIPSOIDS[ellipsoid]
+        f = 1.0 / inverse_flattening
+        n = f / (2.0 - f)
+        self.e = np.sqrt(f * (2.0 - f))
+        self.central_meridian = np.radians(zone * 6.0 - 183.0)
+        self.k0_a = UTM_SCALE_FACTOR * a / (1.0 + n) * (1.0 + n ** 2 / 4.0 + n ** 4 / 64.0)
+        self.alpha = (
+            n / 2.0 - 2.0 * n ** 2 / 3.0 + 5.0 * n ** 3 / 16.0 + 41.0 * n ** 4 / 180.0,
+            13.0 * n ** 2 / 48.0 - 3.0 * n ** 3 / 5.0 + 557.0 * n ** 4 / 1440.0,
+            61.0 * n ** 3 / 240.0 - 103.0 * n ** 4 / 140.0,
+            49561.0 * n ** 4 / 161280.0,
+        )
+        self.beta = (
+            n / 2.0 - 2.0 * n ** 2 / 3.0 + 37.0 * n ** 3 / 96.0 - n ** 4 / 360.0,
+            n ** 2 / 48.0 + n ** 3 / 15.0 - 437.0 * n ** 4 / 1440.0,
+            17.0 * n ** 3 / 480.0 - 37.0 * n ** 4 / 840.0,
+            4397.0 * n ** 4 / 161280.0,
+        )
+
+    def forward(self, lon, lat):
+        """Project lon/lat in degrees to easting/northing."""
+        phi = np.radians(lat)
+        lam = np.radians(lon) - self.central_meridian
+        t = np.sinh(np.arctanh(np.sin(phi)) - self.e * np.arctanh(self.e * np.sin(phi)))
+        xi_prime = np.arctan2(t, np.cos(lam))
+        eta_prime = np.arctanh(np.sin(lam) / np.sqrt(1.0 + t ** 2))
+
+        xi = xi_prime.copy()
+        eta = eta_prime.copy()
+        for j, alpha in enumerate(self.alpha, 1):
+            xi += alpha * np.sin(2 * j * xi_prime) * np.cosh(2 * j * eta_prime)
+            eta += alpha * np.cos(2 * j * xi_prime) * np.sinh(2 * j * eta_prime)
+        return UTM_FALSE_EASTING + self.k0_a * eta, UTM_FALSE_NORTHING + self.k0_a * xi
+
+    def inverse(self, easting, northing):
+        """Unproject easting/northing to lon/lat in degrees."""
+        xi = (northing - UTM_FALSE_NORTHING) / self.k0_a
+        eta = (easting - UTM_FALSE_EASTING) / self.k0_a
+
+        xi_prime = xi.copy()
+        eta_prime = eta.copy()
+        for j, beta in enumerate(self.beta, 1):
+            xi_prime -= beta * np.sin(2 * j * xi) * np.cosh(2 * j * eta)
+            eta_prime -= beta * np.cos(2 * j * xi) * np.sinh(2 * j * eta)
+
+        # Conformal latitude, then Newton's method for the geodetic latitude
+        tau_prime = np.sin(xi_prime) / np.sqrt(np.sinh(eta_prime) ** 2 + np.cos(xi_prime) ** 2)
+        e2 = self.e ** 2
+        tau = tau_prime.copy()
+        for i in range(5):
+            sigma = np.sinh(self.e * np.arctanh(self.e * tau / np.sqrt(1.0 + tau ** 2)))
+            tau_i = tau * np.sqrt(1.0 + sigma ** 2) - sigma * np.sqrt(1.0 + tau ** 2)
+            tau += (tau_prime - tau_i) / np.sqrt(1.0 + tau_i ** 2) * (1.0 + (1.0 - e2) * tau ** 2) / ((1.0 - e2) * np.sqrt(1.0 + tau ** 2))
+
+        lam = np.arctan2(np.sinh(eta_prime), np.cos(xi_prime))
+        return np.degrees(lam + self.central_meridian), np.degrees(np.arctan(tau))
+
+    def forward_point(self, lon, lat):
+        """forward for a single lon/lat, in plain Python, which is much quicker than NumPy for one point."""
+        phi = math.radians(lat)
+        lam = math.radians(lon) - self.central_meridian
+        t = math.sinh(math.atanh(math.sin(phi)) - self.e * math.atanh(self.e * math.sin(phi)))
+        xi_prime = math.atan2(t, math.cos(lam))
+        eta_prime = math.atanh(math.sin(lam) / math.sqrt(1.0 + t ** 2))
+
+        xi = xi_prime
+        eta = eta_prime
+        for j, alpha in enumerate(self.alpha, 1):
+            xi += alpha * math.sin(2 * j * xi_prime) * math.cosh(2 * j * eta_prime)
+            eta += alpha * math.cos(2 * j * xi_prime) * math.sinh(2 * j * eta_prime)
+        return UTM_FALSE_EASTING + self.k0_a * eta, UTM_FALSE_NORTHING + self.k0_a * xi
+
+    def inverse_point(self, easting, northing):
+        """inverse for a single easting/northing, in plain Python."""
+        xi = (northing - UTM_FALSE_NORTHING) / self.k0_a
+        eta = (easting - UTM_FALSE_EASTING) / self.k0_a
+
+        xi_prime = xi
+        eta_prime = eta
+        for j, beta in enumerate(self.beta, 1):
+            xi_prime -= beta * math.sin(2 * j * xi) * math.cosh(2 * j * eta)
+            eta_prime -= beta * math.cos(2 * j * xi) * math.sinh(2 * j * eta)
+
+        tau_prime = math.sin(xi_prime) / math.sqrt(math.sinh(eta_prime) ** 2 + math.cos(xi_prime) ** 2)
+        e2 = self.e ** 2
+        tau = tau_prime
+        for i in range(5):
+            sigma = math.sinh(self.e * math.atanh(self.e * tau / math.sqrt(1.0 + tau ** 2)))
+            tau_i = tau * math.sqrt(1.0 + sigma ** 2) - sigma * math.sqrt(1.0 + tau ** 2)
+            tau += (tau_prime - tau_i) / math.sqrt(1.0 + tau_i ** 2) * (1.0 + (1.0 - e2) * tau ** 2) / ((1.0 - e2) * math.sqrt(1.0 + tau ** 2))
+
+        lam = math.atan2(math.sinh(eta_prime), math.cos(xi_prime))
+        return math.degrees(lam + self.central_meridian), math.degrees(math.atan(tau))
+
+
+class CoordinateSystem(object):
+    """The parts of a Transform's source or target that matter for shifting coordinates."""
+
+    def __init__(self, proj):
+        params = parse_proj(proj)
+        # The only CRS without a proj string is plain GDA94 lon/lat.
+        self.ellipsoid = params.get('ellps', 'GRS80')
+        self.zone = int(params['zone']) if params.get('proj') == 'utm' else None
+        self.grid = params.get('nadgrids')
+        self.projection = TransverseMercator(self.ellipsoid, self.zone) if self.zone else None
+
+    def to_lonlat(self, x, y):
+        if self.projection:
+            return self.projection.inverse(x, y)
+        return x, y
+
+    def from_lonlat(self, lon, lat):
+        if self.projection:
+            return self.projection.forward(lon, lat)
+        return lon, lat
+
+    def point_to_lonlat(self, x, y):
+        if self.projection:
+            return self.projection.inverse_point(x, y)
+        return x, y
+
+    def point_from_lonlat(self, lon, lat):
+        if self.projection:
+            return self.projection.forward_point(lon, lat)
+        return lon, lat
+
+
+@lru_cache(maxsize=128)
+def coordinate_systems(transform):
+    """Source and target CoordinateSystem for a Transform."""
+    return CoordinateSystem(transform.source_proj), CoordinateSystem(transform.target_proj)
+
+
+def transform_coordinates(transform, x, y):
+    """Transform arrays of coordinates in the source CRS of a Transform to its target CRS.
+
+    x and y are lon/lat in degrees for geographic transforms, or easting/northing
+    in the transform's zone for UTM ones. The grid is applied forward when it's on
+    the source side of the transform and inverted when it's on the target side.
+    Points outside the grid coverage come back as NaN.
+    """
+    source, target = coordinate_systems(transform)
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    lon, lat = source.to_lonlat(x, y)
+    if transform.grid:
+        grid = open_grid(transform.grid)
+        lon, lat = grid.shift(lon, lat, inverse=not source.grid)
+    return target.from_lonlat(lon, lat)
+
+
+def transform_point(transform, x, y):
+    """Transform a single coordinate in the source CRS of a Transform to its target CRS, as transform_coordinates does.
+
+    This skips building arrays, and the grid keeps the shifts of the cells it has used
+    recently, so many lookups close together are quick. Returns a tuple of floats, which
+    are NaN if the point is outside the grid coverage.
+    """
+    source, target = coordinate_systems(transform)
+    lon, lat = source.point_to_lonlat(float(x), float(y))
+    if transform.grid:
+        grid = open_grid(transform.grid)
+        lon, lat = grid.shift_point(lon, lat, inverse=not source.grid)
+    if math.isnan(lon):
+        return lon, lat
+    return target.point_from_lonlat(lon, lat)
+
+
+def pixel_coordinates(geotransform, pixel, line):
+    """Coordinates of positions in a raster, given as fractional pixel and line numbers, from its GDAL geotransform."""
+    x0, x_pixel, x_line, y0, y_pixel, y_line = geotransform
+    return x0 + pixel * x_pixel + line * x_line, y0 + pixel * y_pixel + line * y_line
+
+
+def _mesh_error(transform, geotransform, pixel, line, x, y, checks=MESH_CHECKS):
+    """The largest distance between the exact transform and a bilinear interpolation of the mesh, at
+    the points dividing each cell checks times across and down, its edges included and corners left out.
+    """
+    fractions = np.linspace(0.0, 1.0, checks + 1)
+    across, down = (values.ravel() for values in np.meshgrid(fractions, fractions))
+    inner = ~(np.isin(across, (0.0, 1.0)) & np.isin(down, (0.0, 1.0)))
+    across, down = across[inner, None, None], down[inner, None, None]
+
+    def interpolate(values):
+        return ((1.0 - across) * (1.0 - down) * values[:-1, :-1] + across * (1.0 - down) * values[:-1, 1:]
+                + (1.0 - across) * down * values[1:, :-1] + across * down * values[1:, 1:])
+
+    exact_x, exact_y = transform_coordinates(transform, *pixel_coordinates(geotransform, interpolate(pixel), interpolate(line)))
+    distance = np.hypot(exact_x - interpolate(x), exact_y - interpolate(y))
+    if not np.isfinite(distance).any():
+        return 0.0
+    return float(np.nanmax(distance))
+
+
+def transform_mesh(transform, geotransform, width, height, max_error=0.125, step=MESH_STEP):
+    """A mesh of target coordinates for a raster in the source CRS of a Transform, for warping it.
+
+    The mesh has a node every step pixels and lines from the top left corner of the raster,
+    reaching to or past its far edges, and is made finer until interpolating it bilinearly is
+    within max_error pixels of the exact transform on a lattice of MESH_CHECKS divisions across
+    each cell. max_error isn't guaranteed: between those points, and where the grid's own cells
+    change within a mesh cell, the error can be larger, and the warp's inverse of the mesh adds
+    some of its own. Returns arrays of the target x and y at the nodes (NaN outside the grid),
+    the step used and the largest error found, in pixels.
+    """
+    x0, x_pixel, x_line, y0, y_pixel, y_line = geotransform
+    pixel_size = min(np.hypot(x_pixel, y_pixel), np.hypot(x_line, y_line))
+    step = max(1, int(step))
+    while True:
+        line, pixel = np.mgrid[0:-(-height // step) + 1, 0:-(-width // step) + 1].astype(np.float64) * step
+        x, y = transform_coordinates(transform, *pixel_coordinates(geotransform, pixel, line))
+        error = _mesh_error(transform, geotransform, pixel, line, x, y) / pixel_size
+        if error <= max_error or step == 1:
+            return x, y, step, error
+        step //= 2
+
+
+def raster_shift(transform, geotransform, width, height, samples=SHIFT_SAMPLES):
+    """The translation that comes closest to a Transform over a raster in its source CRS.
+
+    The transform is sampled on a lattice of samples cells each way over the raster, edges and
+    corners included. Returns the x and y offsets in the target CRS, halfway between the smallest
+    and largest offsets seen, and the furthest any sample is from that translation, in pixels.
+    Returns None if any of the raster is outside the grid.
+    """
+    x0, x_pixel, x_line, y0, y_pixel, y_line = geotransform
+    pixel_size = min(np.hypot(x_pixel, y_pixel), np.hypot(x_line, y_line))
+    line, pixel = np.mgrid[0:samples + 1, 0:samples + 1].astype(np.float64)
+    x, y = pixel_coordinates(geotransform, pixel * float(width) / samples, line * float(height) / samples)
+    target_x, target_y = transform_coordinates(transform, x, y)
+    dx = target_x - x
+    dy = target_y - y
+    if not (np.isfinite(dx).all() and np.isfinite(dy).all()):
+        return None
+    offset_x = (dx.min() + dx.max()) / 2.0
+    offset_y = (dy.min() + dy.max()) / 2.0
+    error = np.max(np.hypot(dx - offset_x, dy - offset_y)) / pixel_size
+    return float(offset_x), float(offset_y), float(error)
+
+
+def is_grid_shift(transform):
+    """Whether a Transform only shifts coordinates with its grid, keeping the ellipsoid and projection the same."""
+    source, target = coordinate_systems(transform)
+    return bool(transform.grid) and source.ellipsoid == target.ellipsoid and source.zone == target.zone
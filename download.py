@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ download
+                                 A QGIS plugin
+ This plugin uses official ICSM grids to transform between Australian coordinate systems.
+                              -------------------
+        begin                : 2017-01-08
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Alex Leith
+        email                : alex@auspatious.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+ Resumable, verified downloads of grid files.
+
+ Files are streamed into a '.part' file next to the destination. An
+ interrupted download is picked up again with an HTTP Range request, the
+ result is checked against a SHA256SUMS manifest and only then renamed into
+ place, so a half downloaded grid is never used. Nothing here needs QGIS.
+"""
+
+import hashlib
+import os
+import os.path
+import re
+import time
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+# Name of the checksum manifest, in the format written by sha256sum
+MANIFEST_FILE = 'SHA256SUMS'
+CHUNK_SIZE = 1024 * 1024
+TIMEOUT = 60
+RETRIES = 5
+
+
+class DownloadError(Exception):
+    """Raised when a file can't be downloaded or fails verification."""
+
+
+class DownloadCancelled(DownloadError):
+    """Raised when the progress callback asks for a download to stop."""
+
+
+def parse_manifest(text):
+    """Read the lines of a sha256sum style manifest into a dict of file name to checksum."""
+    checksums = {}
+    for line in text.splitlines():
+        match = re.match(r'^([0-9a-fA-F]{64})\s+\*?(.+)$', line.strip())
+        if match:
+            checksums[os.path.basename(match.group(2).strip())] = match.group(1).lower()
+    return checksums
+
+
+def fetch_manifest(base_url, timeout=TIMEOUT):
+    """Fetch the checksum manifest from next to the files. Returns an empty dict if there isn't one."""
+    try:
+        with urlopen(base_url + MANIFEST_FILE, timeout=timeout) as response:
+            return parse_manifest(response.read().decode('utf-8', 'replace'))
+    except (HTTPError, URLError, OSError, ValueError):
+        return {}
+
+
+def sha256(file_name):
+    digest = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _total_length(response, offset):
+    """The full size of the remote file, from a Content-Range or Content-Length header."""
+    content_range = response.headers.get('Content-Range')
+    if content_range and '/' in content_range:
+        total = content_range.rsplit('/', 1)[1]
+        if total.isdigit():
+            return int(total)
+    content_length = response.headers.get('Content-Length')
+    if content_length and content_length.isdigit():
+        return int(content_length) + offset
+    return None
+
+
+def _fetch(url, part_file, progress=None, timeout=TIMEOUT):
+    """Stream url into part_file, continuing from whatever is already there."""
+    offset = os.path.getsize(part_file) if os.path.isfile(part_file) else 0
+    request = Request(url)
+    if offset:
+        request.add_header('Range', 'bytes={}-'.format(offset))
+    try:
+        response = urlopen(request, timeout=timeout)
+    except HTTPError as e:
+        if e.code == 416 and offset:
+            # Nothing left to fetch, the part file is already complete
+            return offset
+        raise
+
+    with response:
+        if offset and response.status != 206:
+            # The server ignored the range, so start again from scratch
+            offset = 0
+        total = _total_length(response, offset)
+        mode = 'ab' if offset else 'wb'
+        received = offset
+        with open(part_file, mode) as f:
+            for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+                f.write(chunk)
+                received += len(chunk)
+                if progress and progress(received, total) is False:
+                    raise DownloadCancelled("Download of {} cancelled".format(url))
+    if total is not None and received != total:
+        raise DownloadError("Connection closed after {} of {} bytes".format(received, total))
+    return total
+
+
+def download_file(url, local_file, checksum=None, validate=None, progress=None, retries=RETRIES, timeout=TIMEOUT):
+    """Download url to local_file, resuming after dropped connections.
+
+    checksum is the expected SHA-256 of the file, and validate is an optional callable
+    that is given the downloaded file and raises an exception if it isn't usable. The
+    file is only moved to local_file once it has passed both checks. progress is called
+    with the bytes received and the total (None if that isn't known), and can return
+    False to cancel the download.
+    """
+    part_file = local_file + '.part'
+    attempt = 0
+    while True:
+        try:
+            _fetch(url, part_file, progress, timeout)
+            break
+        except DownloadCancelled:
+            # Keep the part file, so the download can carry on next time
+            raise
+        except HTTPError as e:
+            if e.code < 500:
+                raise DownloadError("Failed to download {}: HTTP {}".format(url, e.code))
+            error = e
+        except (URLError, OSError, DownloadError) as e:
+            error = e
+        attempt += 1
+        if attempt > retries:
+            raise DownloadError("Failed to download {} after {} attempts: {}".format(url, attempt, error))
+        # Back off a little before resuming
+        time.sleep(min(2 ** attempt, 30))
+
+    try:
+        if checksum:
+            actual = sha256(part_file)
+            if actual != checksum.lower():
+                raise DownloadError("Checksum of {} is {}, expected {}".format(os.path.basename(local_file), actual, checksum))
+        if validate:
+            try:
+                validate(part_file)
+            except Exception as e:
+                raise DownloadError("Downloaded {} isn't valid: {}".format(os.path.basename(local_file), e))
+    except DownloadError:
+        # A complete but bad file can't be resumed, so throw it away
+        os.remove(part_file)
+        raise
+
+    os.replace(part_file, local_file)
+    return local_file
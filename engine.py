@@ -0,0 +1,617 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ engine
+                                 A QGIS plugin
+ This plugin uses official ICSM grids to transform between Australian coordinate systems.
+                              -------------------
+        begin                : 2017-01-08
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Alex Leith
+        email                : alex@auspatious.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+ File transformations that don't depend on the plugin dialog, so that they
+ can be shared by the plugin and the command line tool. Vector files are
+ transformed in vectors.
+"""
+
+import os
+import os.path
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+
+from osgeo.gdalconst import GA_ReadOnly
+from osgeo import gdal, ogr, osr
+
+from .coordinates import CoordinateSystem, raster_shift, transform_mesh, utm_zone
+from .download import DownloadCancelled, DownloadError, download_file, fetch_manifest
+from .gridcache import GridCache, cropped_grid
+from .ntv2 import NTv2Error, validate_grid
+from .probe import probe_file
+from .qa import QA_POINTS, QA_TOLERANCE, round_trip, summary
+from .timing import NO_TIMER
+from .transforms import rezone, source_zone, with_grid
+from qgis.core import (QgsCoordinateReferenceSystem, QgsCoordinateTransform, QgsCoordinateTransformContext, QgsMessageLog,
+                       QgsVectorLayer, Qgis)
+
+# This is the GitHub source
+# GRID_FILE_SOURCE = "https://github.com/icsm-au/transformation_grids/raw/master/"
+# This is the AWS S3 source
+GRID_FILE_SOURCE = "https://s3-ap-southeast-2.amazonaws.com/transformation-grids/"
+
+# Memory for each chunk of a raster warp, in bytes
+WARP_MEMORY_LIMIT = 512 * 1024 * 1024
+# Value for nodes of a warp mesh outside the grid
+MESH_NODATA = -1e30
+# Number of features between progress reports
+PROGRESS_INTERVAL = 1000
+# Number of transforms to keep CRS objects for
+CRS_CACHE_SIZE = 32
+
+# An output driver, with the extension and creation options to use for it
+OutputFormat = namedtuple('OutputFormat', ['driver', 'extension', 'description', 'dataset_options', 'layer_options'])
+
+VECTOR_FORMATS = OrderedDict([
+    ('shp', OutputFormat('ESRI Shapefile', '.shp', 'Shapefile', [], ['ENCODING=UTF-8'])),
+    ('gpkg', OutputFormat('GPKG', '.gpkg', 'GeoPackage', [], ['SPATIAL_INDEX=YES'])),
+    ('fgb', OutputFormat('FlatGeobuf', '.fgb', 'FlatGeobuf', [], ['SPATIAL_INDEX=YES'])),
+])
+
+# Raster creation options go in layer_options, and NUM_THREADS is added when warping
+RASTER_FORMATS = OrderedDict([
+    ('tif', OutputFormat('GTiff', '.tiff', 'GeoTIFF', [], ['TILED=YES', 'BIGTIFF=IF_SAFER'])),
+    ('cog', OutputFormat('COG', '.tif', 'Cloud Optimised GeoTIFF', [],
+                         ['COMPRESS=DEFLATE', 'PREDICTOR=YES', 'OVERVIEWS=AUTO', 'OVERVIEW_RESAMPLING=NEAREST', 'BIGTIFF=IF_SAFER'])),
+])
+
+# Resampling methods for raster warps, by their GDAL names
+RESAMPLING_METHODS = OrderedDict([
+    ('near', 'Nearest neighbour'),
+    ('bilinear', 'Bilinear'),
+    ('cubic', 'Cubic'),
+    ('cubicspline', 'Cubic spline'),
+    ('lanczos', 'Lanczos'),
+    ('average', 'Average'),
+    ('mode', 'Mode'),
+])
+
+# How to warp a raster. error_threshold is the largest error allowed when approximating the
+# transformation, in pixels. With mesh, the transformation is worked out on a coarse mesh
+# over the raster up front, which is then interpolated for every pixel, instead of running
+# proj and the grid for every block of pixels. The mesh is made finer until its error, checked
+# on a lattice within each cell, is within error_threshold, which is an estimate rather than a
+# bound. With shift, a raster the transformation moves evenly, to within error_threshold, is
+# copied with its origin moved instead of warped.
+WarpSettings = namedtuple('WarpSettings', ['resampling', 'error_threshold', 'mesh', 'shift'])
+
+DEFAULT_WARP = WarpSettings('near', 0.125, False, False)
+
+
+class TransformError(Exception):
+    """Raised when a file can't be read or transformed."""
+
+
+class WarpProgress(object):
+    """GDAL progress callback that tracks throughput and passes progress on to an optional callable."""
+
+    def __init__(self, src_ds, progress=None):
+        self.progress = progress
+        self.total_pixels = src_ds.RasterXSize * src_ds.RasterYSize
+        self.start = time.time()
+        self.complete = 0.0
+        self.cancelled = False
+
+    @property
+    def elapsed(self):
+        return time.time() - self.start
+
+    @property
+    def pixels(self):
+        return int(self.total_pixels * self.complete)
+
+    @property
+    def throughput(self):
+        """Source pixels per second"""
+        return self.pixels / max(self.elapsed, 1e-6)
+
+    def __call__(self, complete, message=None, data=None):
+        self.complete = complete
+        if self.progress:
+            message = "{:.0%} complete, {:.1f} megapixels per second".format(complete, self.throughput / 1e6)
+            if self.progress(complete, message) is False:
+                self.cancelled = True
+                return 0
+        return 1
+
+
+def log(message, error=False):
+    log_level = Qgis.Info
+    if error:
+        log_level = Qgis.Critical
+    QgsMessageLog.logMessage(message, 'ICSM NTv2 Transformer', level=log_level)
+
+
+def output_format(out_file, formats, name=None):
+    """The key of the output format to use for a file, from its name if given, otherwise from the file's extension.
+
+    formats is VECTOR_FORMATS or RASTER_FORMATS, and the first of them is the default.
+    """
+    if name:
+        if name not in formats:
+            raise TransformError("Unknown output format {}, use one of {}".format(name, ', '.join(formats)))
+        return name
+    extension = os.path.splitext(out_file)[1].lower()
+    for key, out_format in formats.items():
+        if extension == out_format.extension or (extension == '.tif' and out_format.extension == '.tiff'):
+            return key
+    return next(iter(formats))
+
+
+def with_extension(out_file, out_format):
+    """The out file name, with the extension of an OutputFormat if it doesn't already have it."""
+    base, extension = os.path.splitext(out_file)
+    if extension.lower() == out_format.extension or (extension.lower() in ('.tif', '.tiff') and out_format.extension in ('.tif', '.tiff')):
+        return out_file
+    if extension.lower() in [f.extension for f in VECTOR_FORMATS.values()] + ['.tif', '.tiff']:
+        out_file = base
+    return out_file + out_format.extension
+
+
+def output_size(out_file):
+    """Bytes written for an output, including the files that go with a shapefile."""
+    base, extension = os.path.splitext(out_file)
+    names = [out_file]
+    if extension.lower() == '.shp':
+        names += [base + sidecar for sidecar in ('.shx', '.dbf', '.prj', '.cpg')]
+    return sum(os.path.getsize(name) for name in names if os.path.isfile(name))
+
+
+def delete_vector(out_file):
+    """Remove a vector file written by transform_vector_file, along with its sidecar files."""
+    if not os.path.exists(out_file):
+        return
+    driver = ogr.GetDriverByName(VECTOR_FORMATS[output_format(out_file, VECTOR_FORMATS)].driver)
+    if driver is None or driver.DeleteDataSource(out_file) != 0:
+        os.remove(out_file)
+
+
+def _fetch_grid(grid, manifest=None, progress=None, keep=()):
+    """Download a grid into the grid directory unless another process already has, recording its use in the directory's manifest.
+
+    manifest is the published checksums, which are fetched if they aren't given, and keep is the
+    other grids the job needs, which aren't removed to make room for this one. A download
+    cancelled through progress raises DownloadCancelled, rather than being reported as a failure.
+    """
+    grid_file = os.path.basename(grid)
+
+    def download():
+        remote_file = GRID_FILE_SOURCE + grid_file
+        log("Updating local grid file file {} from {}".format(grid_file, remote_file))
+        checksum = (manifest if manifest is not None else fetch_manifest(GRID_FILE_SOURCE)).get(grid_file)
+        if not checksum:
+            log("No checksum published for {}, only checking the grid structure".format(grid_file))
+        download_file(remote_file, grid, checksum, validate=validate_grid, progress=progress)
+        log("Successfully download file of size {} to {}".format(os.path.getsize(grid), grid))
+
+    try:
+        GridCache(os.path.dirname(grid)).fetch(grid, download, keep)
+    except DownloadCancelled:
+        log("Download of {} cancelled".format(grid_file))
+        raise
+    except DownloadError as e:
+        log("Failed to download .GSB file. {}".format(e), True)
+        return False
+    except OSError as e:
+        # A shared grid directory may be read only, which is fine as long as the grid is there
+        if not os.path.isfile(grid):
+            log("Failed to get .GSB file. {}".format(e), True)
+            return False
+        log("Couldn't update the grid directory manifest: {}".format(e))
+    return True
+
+
+def ensure_grid(grid, progress=None, timer=NO_TIMER):
+    """Download a grid file if it isn't available locally. Returns whether the grid is available.
+
+    progress is passed on to download_file, and DownloadCancelled is raised if it cancels the download.
+    The use of the grid is recorded in the grid directory's manifest, and the least recently used grids
+    are removed if the directory is over its size limit.
+    """
+    if not grid:
+        return True
+    if os.path.isfile(grid):
+        return _fetch_grid(grid)
+    with timer.span('grid_download', grid=os.path.basename(grid)) as span:
+        available = _fetch_grid(grid, progress=progress)
+        if available:
+            span.set(bytes=os.path.getsize(grid))
+    return available
+
+
+def prefetch_grids(grids, workers=4):
+    """Download any missing grids concurrently. Returns whether they are all available."""
+    grids = [grid for grid in grids if grid]
+    if not grids:
+        return True
+    missing = [grid for grid in grids if not os.path.isfile(grid)]
+    manifest = None
+    if missing:
+        log("Downloading grid files {}".format(', '.join(os.path.basename(grid) for grid in missing)))
+        manifest = fetch_manifest(GRID_FILE_SOURCE)
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(grids)))) as executor:
+        return all(executor.map(lambda grid: _fetch_grid(grid, manifest, keep=grids), grids))
+
+
+def open_input(file_name, timer=NO_TIMER):
+    """Open a file as a vector layer or raster dataset.
+
+    Returns a tuple of 'VECTOR' or 'RASTER', the opened layer or dataset, and the CRS authid.
+    """
+    if not os.path.isfile(file_name):
+        raise TransformError("There's no file at {}".format(file_name))
+
+    with timer.span('probe', bytes=os.path.getsize(file_name)) as span:
+        probe = probe_file(file_name)
+        if probe is not None:
+            span.set(file_type=probe.file_type, crs=probe.crs)
+    if probe is None:
+        raise TransformError("Couldn't read {} as vector or raster".format(file_name))
+
+    with timer.span('open', file_type=probe.file_type):
+        if probe.file_type == 'VECTOR':
+            layer = QgsVectorLayer(file_name, 'in layer', 'ogr')
+            if layer.isValid():
+                return 'VECTOR', layer, probe.crs
+        else:
+            dataset = gdal.Open(file_name, GA_ReadOnly)
+            if dataset is not None:
+                return 'RASTER', dataset, probe.crs
+
+    raise TransformError("Couldn't read {} as vector or raster".format(file_name))
+
+
+def dataset_extent(file_type, dataset):
+    """The (xmin, ymin, xmax, ymax) extent of an opened layer or raster dataset, in its own CRS."""
+    if file_type == 'VECTOR':
+        extent = dataset.extent()
+        if extent.isEmpty():
+            return None
+        return extent.xMinimum(), extent.yMinimum(), extent.xMaximum(), extent.yMaximum()
+    x, x_size, __, y, __, y_size = dataset.GetGeoTransform()
+    xs = (x, x + x_size * dataset.RasterXSize)
+    ys = (y, y + y_size * dataset.RasterYSize)
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def lonlat_extent(transform, extent):
+    """The extent in degrees of an extent in the source CRS of a transform, following its edges."""
+    xmin, ymin, xmax, ymax = extent
+    edge = np.linspace(0.0, 1.0, 11)
+    x = np.concatenate([xmin + (xmax - xmin) * edge, np.full(11, xmax), xmin + (xmax - xmin) * edge, np.full(11, xmin)])
+    y = np.concatenate([np.full(11, ymin), ymin + (ymax - ymin) * edge, np.full(11, ymax), ymin + (ymax - ymin) * edge])
+    lon, lat = CoordinateSystem(transform.source_proj).to_lonlat(x, y)
+    return float(np.min(lon)), float(np.min(lat)), float(np.max(lon)), float(np.max(lat))
+
+
+def crop_transform(transform, extent, timer=NO_TIMER):
+    """The transform, using an extract of its grid that only covers an extent in the source CRS.
+
+    Extracts are cached on disk and shared between jobs. If the grid can't be cropped, the
+    transform is returned as it is.
+    """
+    if not transform.grid or extent is None or not os.path.isfile(transform.grid):
+        return transform
+    with timer.span('grid_crop', grid=os.path.basename(transform.grid)) as span:
+        try:
+            grid = cropped_grid(transform.grid, *lonlat_extent(transform, extent))
+        except (NTv2Error, OSError) as e:
+            log("Couldn't crop {}, using all of it: {}".format(os.path.basename(transform.grid), e), True)
+            return transform
+        if grid is None:
+            return transform
+        span.set(bytes=os.path.getsize(grid), full_bytes=os.path.getsize(transform.grid))
+    return with_grid(transform, grid)
+
+
+def check_round_trip(transform, extent, points=QA_POINTS, tolerance=QA_TOLERANCE, job='', timer=NO_TIMER):
+    """Send points over an extent in the source CRS through the transform and back, and log how close they came back.
+
+    The points go forward through PROJ, as the output was written, and back through the grid
+    reader, so a grid PROJ didn't find or applied differently shows up as residuals. Returns a
+    QAResult, or None if the check couldn't be made. It's made after the output has been
+    written, so it never raises.
+    """
+    if not points:
+        return None
+    prefix = "{}: ".format(job) if job else ''
+    try:
+        with timer.span('qa', points=points) as span:
+            result = round_trip(transform, extent, points, tolerance, forward=proj_transform(transform))
+            span.set(failed=result.failed if result else 0)
+    except (NTv2Error, OSError, RuntimeError) as e:
+        log("{}Round trip check failed to run: {}".format(prefix, e), True)
+        return None
+    log(prefix + summary(result), bool(result and result.failed))
+    return result
+
+
+@lru_cache(maxsize=CRS_CACHE_SIZE)
+def _qgis_crs(transform):
+    source_crs = QgsCoordinateReferenceSystem()
+    if transform.source_proj:
+        log("Source from proj")
+        log(transform.source_proj)
+        source_crs.createFromProj4(transform.source_proj)
+    else:
+        log("Source from id")
+        source_crs.createFromId(transform.source_code)
+
+    log("Setting final target CRS from id")
+    dest_crs = QgsCoordinateReferenceSystem()
+    dest_crs.createFromId(transform.target_code)
+
+    # Reproject using the proj string, so the grid is applied, but write the features
+    # out with the EPSG code so the target gets a proper SRID.
+    if transform.target_proj:
+        log("Setting intermediate CRS from proj")
+        log(transform.target_proj)
+        target_crs = QgsCoordinateReferenceSystem()
+        target_crs.createFromProj4(transform.target_proj)
+    else:
+        target_crs = dest_crs
+    return source_crs, target_crs, dest_crs
+
+
+def qgis_crs(transform, context=None):
+    """The source, target (from proj) and final (from EPSG) CRSs of a transform, and the coordinate transform to use.
+
+    The CRSs are built once for each transform and cached, and copies are returned, so they can be
+    used on any thread. context is the QgsCoordinateTransformContext for the coordinate transform.
+    The project's can only be read on the main thread, so it has to be passed in from there. An
+    empty one is used otherwise, which is enough, as the proj strings name the grids themselves.
+    """
+    source_crs, target_crs, dest_crs = (QgsCoordinateReferenceSystem(crs) for crs in _qgis_crs(transform))
+    coordinate_transform = QgsCoordinateTransform(source_crs, target_crs, context if context is not None else QgsCoordinateTransformContext())
+    return source_crs, target_crs, dest_crs, coordinate_transform
+
+
+@lru_cache(maxsize=CRS_CACHE_SIZE)
+def gdal_wkt(transform):
+    """The source, target and final WKT of a transform for GDAL, cached for each transform.
+
+    The final WKT is the one for the target EPSG code, to assign after warping with the
+    proj based target. It's None if the target didn't need proj or the code isn't known.
+    """
+    # Define source CRS
+    src_crs = osr.SpatialReference()
+    if transform.source_proj:
+        log("Source from proj")
+        src_crs.ImportFromProj4(transform.source_proj)
+    else:
+        log("Source from code")
+        src_crs.ImportFromEPSG(transform.source_code)
+    src_wkt = src_crs.ExportToWkt()
+
+    # Define target CRS
+    dst_crs = osr.SpatialReference()
+    if transform.target_proj:
+        log("Target from proj")
+        dst_crs.ImportFromProj4(transform.target_proj)
+    else:
+        log("Target from code")
+        dst_crs.ImportFromEPSG(transform.target_code)
+    dst_wkt = dst_crs.ExportToWkt()
+
+    final_wkt = None
+    if transform.target_proj:
+        srs = 'EPSG:{}'.format(transform.target_code)
+        sr = osr.SpatialReference()
+        if sr.SetFromUserInput(srs) != 0:
+            log('Failed to process SRS definition: {}. This may mean that you need a newer QGIS install.'.format(srs), True)
+        else:
+            final_wkt = sr.ExportToWkt()
+    return src_wkt, dst_wkt, final_wkt
+
+
+def proj_transform(transform):
+    """A function sending arrays of x and y in the source CRS of a transform to the target CRS through PROJ.
+
+    This is the way GDAL and OGR transform coordinates when they warp or write a file, from the
+    proj strings with their +nadgrids. Points that PROJ can't transform come back as infinity.
+    """
+    src_wkt, dst_wkt, final_wkt = gdal_wkt(transform)
+    src_srs, dst_srs = osr.SpatialReference(src_wkt), osr.SpatialReference(dst_wkt)
+    for srs in (src_srs, dst_srs):
+        if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+            srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    coordinate_transform = osr.CoordinateTransformation(src_srs, dst_srs)
+
+    def forward(x, y):
+        points = np.array(coordinate_transform.TransformPoints(np.column_stack([x, y]).tolist()), dtype=np.float64)
+        return points[:, 0], points[:, 1]
+    return forward
+
+
+def mesh_dataset(transform, src_ds, srs_wkt, error_threshold, timer=NO_TIMER):
+    """A virtual copy of a raster with a mesh of its coordinates in the target CRS as geolocation arrays.
+
+    Warping it with the geolocation arrays interpolates the mesh rather than transforming every
+    block with proj. The mesh is kept in a /vsimem file, which is returned for deleting afterwards.
+    """
+    with timer.span('mesh', nodes=0) as span:
+        x, y, step, error = transform_mesh(
+            transform, src_ds.GetGeoTransform(), src_ds.RasterXSize, src_ds.RasterYSize, error_threshold)
+        if not np.isfinite(x).any():
+            raise TransformError("The raster is outside the transformation grid")
+        span.set(nodes=x.size, step=step, error=round(error, 6))
+
+    mesh_file = '/vsimem/{}_mesh_{}.tif'.format(os.path.splitext(os.path.basename(src_ds.GetDescription()))[0], id(src_ds))
+    mesh_ds = gdal.GetDriverByName('GTiff').Create(mesh_file, x.shape[1], x.shape[0], 2, gdal.GDT_Float64)
+    for band_number, values in ((1, x), (2, y)):
+        band = mesh_ds.GetRasterBand(band_number)
+        band.SetNoDataValue(MESH_NODATA)
+        band.WriteArray(np.where(np.isfinite(values), values, MESH_NODATA))
+    mesh_ds = None
+
+    vrt_ds = gdal.Translate('', src_ds, options=gdal.TranslateOptions(format='VRT'))
+    vrt_ds.SetMetadata({
+        'SRS': srs_wkt,
+        'X_DATASET': mesh_file,
+        'X_BAND': '1',
+        'Y_DATASET': mesh_file,
+        'Y_BAND': '2',
+        'PIXEL_OFFSET': '0',
+        'LINE_OFFSET': '0',
+        'PIXEL_STEP': str(step),
+        'LINE_STEP': str(step),
+        'GEOREFERENCING_CONVENTION': 'TOP_LEFT_CORNER',
+    }, 'GEOLOCATION')
+    return vrt_ds, mesh_file
+
+
+def transform_raster_file(transform, src_ds, out_file, progress=None, threads='ALL_CPUS', out_format=None, timer=NO_TIMER,
+                          warp=DEFAULT_WARP):
+    """Warp a raster dataset into a GeoTIFF with the target EPSG code. Returns the name of the file written.
+
+    progress is called with the fraction complete and a message, and can return False to cancel.
+    threads is the number of warping threads, or 'ALL_CPUS'. out_format is a key of RASTER_FORMATS,
+    and defaults to a tiled GeoTIFF. warp is a WarpSettings. The crs, shift, mesh and write stages
+    are recorded by timer.
+    """
+    out_format = RASTER_FORMATS[output_format(out_file, RASTER_FORMATS, out_format or 'tif')]
+    out_file = with_extension(out_file, out_format)
+    log("Transforming raster to: {} as {}".format(out_file, out_format.description))
+
+    with timer.span('crs', transform=transform.name):
+        src_wkt, dst_wkt, final_wkt = gdal_wkt(transform)
+
+    if warp.resampling not in RESAMPLING_METHODS:
+        raise TransformError("Unknown resampling method {}, use one of {}".format(warp.resampling, ', '.join(RESAMPLING_METHODS)))
+
+    # Warp block by block over output windows, on several threads, into a tiled GeoTIFF.
+    warp_progress = WarpProgress(src_ds, progress)
+    warp_options = dict(
+        srcSRS=src_wkt,
+        dstSRS=dst_wkt,
+        resampleAlg=warp.resampling,
+        errorThreshold=warp.error_threshold,
+        multithread=True,
+        warpMemoryLimit=WARP_MEMORY_LIMIT,
+        warpOptions=['NUM_THREADS={}'.format(threads)],
+    )
+    shifted = None
+    if warp.shift:
+        geotransform = src_ds.GetGeoTransform()
+        with timer.span('shift') as span:
+            shift = raster_shift(transform, geotransform, src_ds.RasterXSize, src_ds.RasterYSize)
+            if shift:
+                span.set(x=shift[0], y=shift[1], error=round(shift[2], 6))
+        if shift and shift[2] <= warp.error_threshold:
+            x0, x_pixel, x_line, y0, y_pixel, y_line = geotransform
+            shifted = (x0 + shift[0], x_pixel, x_line, y0 + shift[1], y_pixel, y_line)
+            log("Shifting raster by ({:.6f}, {:.6f}) without resampling, within {:.4f} pixels".format(*shift))
+        elif shift:
+            log("The shift varies by {:.4f} pixels over the raster, warping it".format(shift[2]))
+        else:
+            log("Some of the raster is outside the grid, warping it")
+
+    mesh_file = None
+    if warp.mesh and not shifted:
+        # The mesh is already in the final CRS, so there's nothing left for proj to do. The mesh
+        # is the approximation, so interpolate it exactly rather than approximating it again.
+        src_ds, mesh_file = mesh_dataset(transform, src_ds, final_wkt or dst_wkt, warp.error_threshold, timer)
+        del warp_options['srcSRS']
+        warp_options.update(dstSRS=final_wkt or dst_wkt, geoloc=True, errorThreshold=0)
+    creation_options = out_format.layer_options + ['NUM_THREADS={}'.format(threads)]
+    with timer.span('write', driver=out_format.driver, resampling='none' if shifted else warp.resampling, pixels=0) as span:
+        try:
+            if shifted:
+                # Only the georeferencing changes, so copy the pixels as they are
+                vrt_ds = gdal.Translate('', src_ds, options=gdal.TranslateOptions(format='VRT'))
+                vrt_ds.SetGeoTransform(shifted)
+                vrt_ds.SetProjection(final_wkt or dst_wkt)
+                dst_ds = gdal.Translate(out_file, vrt_ds, options=gdal.TranslateOptions(
+                    format=out_format.driver, creationOptions=creation_options, callback=warp_progress))
+                vrt_ds = None
+                final_wkt = None
+            elif out_format.driver == 'COG':
+                # COGs can only be copied from another dataset, so warp into a virtual raster,
+                # give it the EPSG code and let the COG driver do the warping as it copies it.
+                vrt_ds = gdal.Warp('', src_ds, options=gdal.WarpOptions(format='VRT', **warp_options))
+                if vrt_ds is not None and final_wkt:
+                    vrt_ds.SetProjection(final_wkt)
+                dst_ds = vrt_ds and gdal.Translate(out_file, vrt_ds, options=gdal.TranslateOptions(
+                    format='COG', creationOptions=creation_options, callback=warp_progress))
+                vrt_ds = None
+                final_wkt = None
+            else:
+                dst_ds = gdal.Warp(out_file, src_ds, options=gdal.WarpOptions(
+                    format=out_format.driver, creationOptions=creation_options, callback=warp_progress, **warp_options))
+        except Exception as e:
+            raise TransformError(str(e))
+        finally:
+            if mesh_file:
+                src_ds = None
+                gdal.Unlink(mesh_file)
+        if warp_progress.cancelled:
+            dst_ds = None
+            if os.path.exists(out_file):
+                gdal.GetDriverByName('GTiff').Delete(out_file)
+            raise TransformError("Transformation cancelled")
+        if dst_ds is None:
+            raise TransformError("Couldn't create {}: {}".format(out_file, gdal.GetLastErrorMsg()))
+
+        # If we transformed using Proj, set the CRS using the EPSG code
+        if final_wkt:
+            dst_ds.SetProjection(final_wkt)
+        dst_ds = None
+        span.set(pixels=warp_progress.pixels, bytes=output_size(out_file),
+                 megapixels_per_second=round(warp_progress.throughput / 1e6, 3))
+    return out_file
+
+
+def zone_file_name(out_file, zone):
+    """The output for one zone of a zoned transformation, such as 'roads_z55.shp' for 'roads.shp'."""
+    base, extension = os.path.splitext(out_file)
+    return '{}_z{}{}'.format(base, zone, extension)
+
+
+def zone_transforms(transform, zones):
+    """The transform to use for each zone, with its target in that zone."""
+    transforms = {}
+    for zone in zones:
+        transforms[zone] = rezone(transform, zone)
+        if transforms[zone] is None:
+            raise TransformError("No transformation from {} into zone {}".format(transform.source_name, zone))
+    return transforms
+
+
+def transform_raster_by_zone(transform, src_ds, out_file, progress=None, threads='ALL_CPUS', out_format=None,
+                             timer=NO_TIMER, warp=DEFAULT_WARP):
+    """Warp a raster into the UTM zone its centre falls in, for tiles of a dataset that spans several zones.
+
+    Returns the list of files written, to match transform_vector_by_zone.
+    """
+    if source_zone(transform) is None:
+        raise TransformError("Only UTM coordinate systems can be split by zone")
+    x, x_size, __, y, __, y_size = src_ds.GetGeoTransform()
+    lon, __ = CoordinateSystem(transform.source_proj).to_lonlat(
+        np.array([x + x_size * src_ds.RasterXSize / 2.0]), np.array([y + y_size * src_ds.RasterYSize / 2.0]))
+    zone = int(utm_zone(lon)[0])
+    zone_transform = zone_transforms(transform, [zone])[zone]
+    out_file = transform_raster_file(zone_transform, src_ds, zone_file_name(out_file, zone), progress, threads, out_format, timer,
+                                     warp)
+    return [out_file]
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ gridcache
+                                 A QGIS plugin
+ This plugin uses official ICSM grids to transform between Australian coordinate systems.
+                              -------------------
+        begin                : 2017-01-08
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Alex Leith
+        email                : alex@auspatious.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+ The directory grids are kept in, and small extracts of them.
+
+ Grids are kept in the plugin's grids folder, or in a shared directory named
+ by ICSM_GRID_DIR, so that every profile and user on a machine can use the
+ same copies. A manifest in the directory records the name, version, size,
+ checksum and last use of each grid and extract. Processes take a lock file
+ before changing the manifest or downloading a grid, so several can share the
+ directory safely. If ICSM_GRID_CACHE_MB is set, the least recently used
+ files are removed once the directory grows past that size.
+
+ An extract holds the subgrid cells covering an extent plus a margin, and is
+ kept on disk keyed by the grid file and the extent, so later jobs over the
+ same area reuse it. Extents are snapped outwards to CROP_ALIGNMENT, so that
+ jobs over nearby areas share extracts. Nothing here needs QGIS.
+"""
+
+import hashlib
+import json
+import math
+import os
+import os.path
+import time
+from contextlib import contextmanager
+
+from .ntv2 import NTv2Error, NTv2Grid, crop_grid
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+# Environment variables for a shared grid directory, and the size it's kept under in megabytes
+GRID_DIR_ENV = 'ICSM_GRID_DIR'
+CACHE_SIZE_ENV = 'ICSM_GRID_CACHE_MB'
+# Version of the manifest layout. A manifest of another version is rebuilt from the files.
+CACHE_FORMAT = 1
+MANIFEST_NAME = 'manifest.json'
+LOCK_NAME = '.manifest.lock'
+# Seconds to wait for the manifest, and for another process to finish downloading a grid
+LOCK_TIMEOUT = 60
+DOWNLOAD_LOCK_TIMEOUT = 60 * 60
+
+# Margin added around an extent before cropping, in degrees (about 10 km)
+CROP_MARGIN = 0.1
+# Cropped extents are snapped outwards to multiples of this, in degrees
+CROP_ALIGNMENT = 0.25
+# Directory for extracts, next to the grids
+CACHE_DIR_NAME = 'extracts'
+
+
+class GridCacheError(OSError):
+    """Raised when the grid directory can't be locked or written."""
+
+
+def grid_dir():
+    """The directory grids are kept in, ICSM_GRID_DIR if it's set, otherwise the plugin's grids folder."""
+    directory = os.environ.get(GRID_DIR_ENV)
+    if directory:
+        return os.path.abspath(os.path.expanduser(directory))
+    return os.path.join(os.path.dirname(__file__), 'grids')
+
+
+def cache_limit():
+    """The size in bytes the grid directory is kept under, or None if there's no limit."""
+    try:
+        megabytes = float(os.environ.get(CACHE_SIZE_ENV) or 0)
+    except ValueError:
+        return None
+    return int(megabytes * 1024 * 1024) if megabytes > 0 else None
+
+
+@contextmanager
+def file_lock(path, timeout=LOCK_TIMEOUT):
+    """Hold an exclusive lock on a file, shared between processes, waiting up to timeout seconds for it."""
+    deadline = time.time() + timeout
+    with open(path, 'a+b') as f:
+        while True:
+            try:
+                if fcntl:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                else:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                break
+            except OSError:
+                if time.time() > deadline:
+                    raise GridCacheError("Timed out waiting for {}".format(path))
+                time.sleep(0.1)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def grid_version(path):
+    """The version of a grid, taken as the latest date any of its subgrids was updated."""
+    try:
+        with NTv2Grid.open(path) as grid:
+            return max((subgrid.updated for subgrid in grid), default='')
+    except (NTv2Error, OSError):
+        return ''
+
+
+def file_checksum(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class GridCache(object):
+    """The manifest of a grid directory, with the files in it keyed by their path relative to it.
+
+    Every change to the manifest is made while holding its lock, and written to a temporary
+    file that's renamed over it, so other processes never see half of one.
+    """
+
+    def __init__(self, directory=None, limit=None):
+        self.directory = os.path.abspath(directory or grid_dir())
+        self.limit = limit if limit is not None else cache_limit()
+
+    @property
+    def manifest_file(self):
+        return os.path.join(self.directory, MANIFEST_NAME)
+
+    def key(self, path):
+        return os.path.relpath(os.path.abspath(path), self.directory).replace(os.sep, '/')
+
+    @contextmanager
+    def locked(self):
+        """Hold the manifest lock, yielding the manifest's entries to change. They're saved afterwards."""
+        os.makedirs(self.directory, exist_ok=True)
+        with file_lock(os.path.join(self.directory, LOCK_NAME)):
+            entries = self.entries()
+            yield entries
+            part_file = self.manifest_file + '.part'
+            with open(part_file, 'w') as f:
+                json.dump({'format': CACHE_FORMAT, 'files': entries}, f, indent=2, sort_keys=True)
+            os.replace(part_file, self.manifest_file)
+
+    def entries(self):
+        """The manifest's entries for files that are still there, read without taking the lock."""
+        try:
+            with open(self.manifest_file) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if manifest.get('format') != CACHE_FORMAT:
+            return {}
+        files = manifest.get('files', {})
+        return dict((key, entry) for key, entry in files.items() if os.path.isfile(os.path.join(self.directory, key)))
+
+    def _entry(self, path, entry):
+        """The entry for a file, worked out again if it's new or has changed since it was recorded."""
+        stat = os.stat(path)
+        if entry and entry.get('size') == stat.st_size and entry.get('mtime') == stat.st_mtime:
+            return entry
+        return {
+            'name': os.path.basename(path),
+            'version': grid_version(path),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'sha256': file_checksum(path),
+            'last_used': time.time(),
+        }
+
+    def touch(self, path):
+        """Record that a file in the directory has just been used, adding it to the manifest if it's new."""
+        key = self.key(path)
+        # A new entry means hashing the whole file, so work it out before taking the lock
+        entry = self._entry(path, self.entries().get(key))
+        with self.locked() as entries:
+            recorded = entries.get(key)
+            if recorded and recorded.get('size') == entry['size'] and recorded.get('mtime') == entry['mtime']:
+                entry = recorded
+            entry['last_used'] = time.time()
+            entries[key] = entry
+            return entry
+
+    def fetch(self, path, download, keep=()):
+        """Make sure a grid is in the directory, calling download() to fetch it if it isn't.
+
+        Only one process downloads a grid at a time. Others wait for it and then use its copy.
+        Afterwards, files beyond the size limit are removed, apart from the grid and the other
+        grids in keep, which the job fetching it needs as well, and their extracts.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        if not os.path.isfile(path):
+            with file_lock(path + '.lock', DOWNLOAD_LOCK_TIMEOUT):
+                if not os.path.isfile(path):
+                    download()
+        self.touch(path)
+        self.evict(keep=[path] + list(keep))
+
+    def evict(self, keep=()):
+        """Remove the least recently used files until the directory is under its size limit.
+
+        Returns the paths removed. Files in keep, and the extracts of grids in keep, aren't
+        removed, and neither are files that are open in another process on systems that don't
+        allow that.
+        """
+        if not self.limit:
+            return []
+        removed = []
+        keep = set(self.key(path) for path in keep)
+        keep_grids = set(os.path.splitext(os.path.basename(key))[0] for key in keep)
+        with self.locked() as entries:
+            total = sum(entry['size'] for entry in entries.values())
+            for key, entry in sorted(entries.items(), key=lambda item: item[1]['last_used']):
+                if total <= self.limit:
+                    break
+                if key in keep or _extract_grid(key) in keep_grids:
+                    continue
+                path = os.path.join(self.directory, key)
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= entry['size']
+                del entries[key]
+                removed.append(path)
+        return removed
+
+
+def _extract_grid(key):
+    """The name of the grid an extract was cut from, given its key in the manifest, or None if it isn't one."""
+    directory, __, name = key.rpartition('/')
+    if directory != CACHE_DIR_NAME:
+        return None
+    return os.path.splitext(name)[0].rsplit('_', 1)[0]
+
+
+def snap_extent(west, south, east, north, margin=CROP_MARGIN, alignment=CROP_ALIGNMENT):
+    """The extent in degrees, with the margin added and snapped outwards to the alignment."""
+    return (
+        math.floor((west - margin) / alignment) * alignment,
+        math.floor((south - margin) / alignment) * alignment,
+        math.ceil((east + margin) / alignment) * alignment,
+        math.ceil((north + margin) / alignment) * alignment,
+    )
+
+
+def extract_path(grid, extent, cache_dir=None):
+    """Where the extract of a grid for a snapped extent is kept.
+
+    The name includes a hash of the grid's path, size and modification time, so extracts of a
+    grid that has been replaced aren't reused.
+    """
+    stat = os.stat(grid)
+    key = '{}|{}|{}|{}'.format(os.path.realpath(grid), stat.st_size, stat.st_mtime, ','.join('{:.6f}'.format(v) for v in extent))
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+    cache_dir = cache_dir or os.path.join(os.path.dirname(os.path.realpath(grid)), CACHE_DIR_NAME)
+    return os.path.join(cache_dir, '{}_{}.gsb'.format(os.path.splitext(os.path.basename(grid))[0], digest))
+
+
+def cropped_grid(grid, west, south, east, north, margin=CROP_MARGIN, cache_dir=None):
+    """The path of an extract of grid covering an extent in degrees, making it if it isn't cached.
+
+    Returns None if the grid doesn't cover any of the extent.
+    """
+    extent = snap_extent(west, south, east, north, margin)
+    path = extract_path(grid, extent, cache_dir)
+    if not os.path.isfile(path):
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        if crop_grid(grid, path, *extent) is None:
+            return None
+    if cache_dir is None:
+        # Extracts next to the grids are part of the grid directory's manifest, so they count towards its size
+        try:
+            GridCache(os.path.dirname(os.path.realpath(grid))).touch(path)
+        except OSError:
+            pass
+    return path
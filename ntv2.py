@@ -0,0 +1,753 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ ntv2
+                                 A QGIS plugin
+ This plugin uses official ICSM grids to transform between Australian coordinate systems.
+                              -------------------
+        begin                : 2017-01-08
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Alex Leith
+        email                : alex@auspatious.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+ Reader for NTv2 (.gsb) transformation grids.
+
+ The grid file is memory mapped and only the overview and subgrid headers are
+ parsed up front. The shift records of each subgrid are exposed as NumPy views
+ straight over the mapped file, so pages are only read when they are used.
+
+ Worker processes that open the same grid map the same file, so they share
+ its pages through the operating system's page cache rather than each
+ holding a copy of the grid.
+"""
+
+import math
+import mmap
+import os
+import struct
+import tempfile
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
+
+# Every NTv2 record is an 8 character key followed by an 8 byte value.
+RECORD_LENGTH = 16
+OVERVIEW_RECORDS = 11
+SUBGRID_RECORDS = 11
+# Each grid node holds lat shift, lon shift, lat accuracy and lon accuracy.
+NODE_VALUES = 4
+
+# Conversion of the GS_TYPE units into arc-seconds
+GS_TYPES = {
+    'SECONDS': 1.0,
+    'MINUTES': 60.0,
+    'DEGREES': 3600.0,
+}
+
+# Convergence of the iterative inverse, in degrees (about 10 micrometres).
+INVERSE_TOLERANCE = 1e-10
+INVERSE_MAX_ITERATIONS = 10
+
+# Most bins along each side of the lookup table of a subgrid's children
+INDEX_BINS = 256
+# Points spread over more subgrids than this are sorted by subgrid before interpolating
+SORT_SUBGRIDS = 16
+# Cells whose corner shifts are kept for single point lookups, in each grid
+CELL_CACHE_SIZE = 4096
+
+
+class NTv2Error(ValueError):
+    """Raised when a file can't be read as an NTv2 grid."""
+
+
+# The solution of the inverse shift for arrays of points. iterations is how many each point took,
+# and converged is False for points that were still moving after the last iteration, which keep
+# their last estimate, and for points outside the grid, which are NaN.
+InverseResult = namedtuple('InverseResult', ['lon', 'lat', 'iterations', 'converged'])
+
+
+class SubGrid(object):
+    """A single subgrid of an NTv2 file.
+
+    Header values are kept in arc-seconds using the NTv2 convention of
+    positive west longitudes. Grid nodes are stored from south to north and,
+    within a row, from east to west.
+    """
+
+    def __init__(self, name, parent, created, updated, s_lat, n_lat, e_long, w_long, lat_inc, long_inc, count, data):
+        self.name = name
+        self.parent = parent
+        self.created = created
+        self.updated = updated
+        self.s_lat = s_lat
+        self.n_lat = n_lat
+        self.e_long = e_long
+        self.w_long = w_long
+        self.lat_inc = lat_inc
+        self.long_inc = long_inc
+        self.count = count
+        self.rows = int(round((n_lat - s_lat) / lat_inc)) + 1
+        self.cols = int(round((w_long - e_long) / long_inc)) + 1
+        if self.rows * self.cols != count:
+            raise NTv2Error("Subgrid {} has {} nodes but its extent needs {}".format(name, count, self.rows * self.cols))
+        # (rows, cols, 4) view over the mapped file, nothing is copied
+        self.data = data.reshape(self.rows, self.cols, NODE_VALUES)
+        self.children = []
+
+    @property
+    def lat_shift(self):
+        return self.data[:, :, 0]
+
+    @property
+    def lon_shift(self):
+        return self.data[:, :, 1]
+
+    @property
+    def lat_accuracy(self):
+        return self.data[:, :, 2]
+
+    @property
+    def lon_accuracy(self):
+        return self.data[:, :, 3]
+
+    @property
+    def is_root(self):
+        return self.parent.upper() == 'NONE'
+
+    @property
+    def extent(self):
+        """The subgrid extent in degrees as (west, south, east, north), with east positive longitudes."""
+        return -self.w_long / 3600.0, self.s_lat / 3600.0, -self.e_long / 3600.0, self.n_lat / 3600.0
+
+    def contains(self, lon_w, lat):
+        """Mask of the points (arc-seconds, positive west) that fall inside this subgrid."""
+        return (lat >= self.s_lat) & (lat <= self.n_lat) & (lon_w >= self.e_long) & (lon_w <= self.w_long)
+
+    def interpolate(self, lon_w, lat):
+        """Bilinearly interpolate the (lat, lon) shifts in arc-seconds at points inside this subgrid."""
+        x = (lon_w - self.e_long) / self.long_inc
+        y = (lat - self.s_lat) / self.lat_inc
+        col = np.clip(np.floor(x).astype(np.intp), 0, max(self.cols - 2, 0))
+        row = np.clip(np.floor(y).astype(np.intp), 0, max(self.rows - 2, 0))
+        fx = x - col
+        fy = y - row
+        col_1 = np.minimum(col + 1, self.cols - 1)
+        row_1 = np.minimum(row + 1, self.rows - 1)
+
+        shifts = []
+        for band in (self.lat_shift, self.lon_shift):
+            lower = band[row, col] * (1.0 - fx) + band[row, col_1] * fx
+            upper = band[row_1, col] * (1.0 - fx) + band[row_1, col_1] * fx
+            shifts.append(lower * (1.0 - fy) + upper * fy)
+        return shifts[0], shifts[1]
+
+    def crop(self, west, south, east, north):
+        """A copy of the nodes of this subgrid that cover an extent in degrees, or None if they don't overlap.
+
+        The crop is widened to whole cells, and to at least one cell each way, so every point
+        inside the extent can still be interpolated.
+        """
+        s_lat, n_lat = south * 3600.0, north * 3600.0
+        e_long, w_long = -east * 3600.0, -west * 3600.0
+        if n_lat < self.s_lat or s_lat > self.n_lat or w_long < self.e_long or e_long > self.w_long:
+            return None
+        row_0, row_1 = self._node_range(s_lat, n_lat, self.s_lat, self.lat_inc, self.rows)
+        col_0, col_1 = self._node_range(e_long, w_long, self.e_long, self.long_inc, self.cols)
+        data = np.array(self.data[row_0:row_1 + 1, col_0:col_1 + 1, :])
+        return SubGrid(
+            self.name, self.parent, self.created, self.updated,
+            self.s_lat + row_0 * self.lat_inc, self.s_lat + row_1 * self.lat_inc,
+            self.e_long + col_0 * self.long_inc, self.e_long + col_1 * self.long_inc,
+            self.lat_inc, self.long_inc, data.shape[0] * data.shape[1], data.ravel()
+        )
+
+    @staticmethod
+    def _node_range(low, high, origin, increment, count):
+        first = max(int(math.floor((low - origin) / increment)), 0)
+        last = min(int(math.ceil((high - origin) / increment)), count - 1)
+        if last - first < 1:
+            last = min(first + 1, count - 1)
+            first = max(last - 1, 0)
+        return first, last
+
+    def __repr__(self):
+        return "SubGrid({!r}, parent={!r}, rows={}, cols={})".format(self.name, self.parent, self.rows, self.cols)
+
+
+class SubgridIndex(object):
+    """Finds which of a set of non-overlapping sibling subgrids hold arrays of points.
+
+    The extent of the siblings is cut into bins no smaller than the smallest of them, each
+    listing the siblings that touch it. A point only has to be checked against the few
+    siblings of its bin. Indexes refer to positions in the grid's list of subgrids.
+    """
+
+    def __init__(self, subgrids, positions):
+        self.positions = np.asarray(positions, dtype=np.intp)
+        self.e_long = np.array([subgrid.e_long for subgrid in subgrids])
+        self.w_long = np.array([subgrid.w_long for subgrid in subgrids])
+        self.s_lat = np.array([subgrid.s_lat for subgrid in subgrids])
+        self.n_lat = np.array([subgrid.n_lat for subgrid in subgrids])
+
+        self.x0, self.y0 = self.e_long.min(), self.s_lat.min()
+        width, height = self.w_long.max() - self.x0, self.n_lat.max() - self.y0
+        self.bin_width = max(width / INDEX_BINS, (self.w_long - self.e_long).min(), 1e-9)
+        self.bin_height = max(height / INDEX_BINS, (self.n_lat - self.s_lat).min(), 1e-9)
+        self.cols = int(width // self.bin_width) + 1
+        self.rows = int(height // self.bin_height) + 1
+
+        # Members of each bin, in file order so that the last one wins on shared edges
+        members = [[] for __ in range(self.rows * self.cols)]
+        for i in range(len(subgrids)):
+            cols = self._bins(np.array([self.e_long[i], self.w_long[i]]), self.x0, self.bin_width, self.cols)
+            rows = self._bins(np.array([self.s_lat[i], self.n_lat[i]]), self.y0, self.bin_height, self.rows)
+            for row in range(rows[0], rows[1] + 1):
+                for col in range(cols[0], cols[1] + 1):
+                    members[row * self.cols + col].append(i)
+        self.start = np.cumsum([0] + [len(bin_members) for bin_members in members])
+        self.members = np.array([i for bin_members in members for i in bin_members], dtype=np.intp)
+        self.depth = max(len(bin_members) for bin_members in members)
+        # Plain Python copies for finding single points, which is quicker without NumPy
+        self._bin_members = members
+        self._extents = [(float(e), float(w), float(s), float(n)) for e, w, s, n in
+                         zip(self.e_long, self.w_long, self.s_lat, self.n_lat)]
+        self._positions = [int(position) for position in self.positions]
+
+    @staticmethod
+    def _bins(values, origin, size, count):
+        # Clip before casting, so that points outside any bin go in the nearest one. Points
+        # that aren't finite go in the first, where they can't be inside any of its siblings.
+        bins = np.floor((np.asarray(values, dtype=np.float64) - origin) / size)
+        return np.clip(np.where(np.isfinite(bins), bins, 0.0), 0, count - 1).astype(np.intp)
+
+    def lookup(self, lon_w, lat):
+        """Position of the sibling holding each point (arc-seconds, positive west), or -1 if none does."""
+        bins = (self._bins(lat, self.y0, self.bin_height, self.rows) * self.cols
+                + self._bins(lon_w, self.x0, self.bin_width, self.cols))
+        start = self.start[bins]
+        count = self.start[bins + 1] - start
+        found = np.full(lat.shape, -1, dtype=np.intp)
+        for k in range(self.depth):
+            points = np.flatnonzero(count > k)
+            if not points.size:
+                break
+            candidate = self.members[start[points] + k]
+            inside = ((lat[points] >= self.s_lat[candidate]) & (lat[points] <= self.n_lat[candidate])
+                      & (lon_w[points] >= self.e_long[candidate]) & (lon_w[points] <= self.w_long[candidate]))
+            found[points[inside]] = self.positions[candidate[inside]]
+        return found
+
+    def find(self, lon_w, lat):
+        """Position of the sibling holding a single point (arc-seconds, positive west), or -1 if none does."""
+        if not (math.isfinite(lon_w) and math.isfinite(lat)):
+            return -1
+        col = min(max(int(math.floor((lon_w - self.x0) / self.bin_width)), 0), self.cols - 1)
+        row = min(max(int(math.floor((lat - self.y0) / self.bin_height)), 0), self.rows - 1)
+        found = -1
+        for i in self._bin_members[row * self.cols + col]:
+            e_long, w_long, s_lat, n_lat = self._extents[i]
+            if s_lat <= lat <= n_lat and e_long <= lon_w <= w_long:
+                found = self._positions[i]
+        return found
+
+
+class NTv2Grid(object):
+    """An NTv2 grid file, parsed once and memory mapped."""
+
+    def __init__(self, buffer, path=None):
+        self.path = path
+        self._buffer = buffer
+        self.subgrids = []
+        self._parse()
+        self._build_index()
+        self.cell_shifts = lru_cache(maxsize=CELL_CACHE_SIZE)(self._cell_shifts)
+
+    @classmethod
+    def open(cls, path):
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(mapped, path)
+
+    def close(self):
+        # Views into the buffer have to be released before the map can close.
+        self.subgrids = []
+        self._index = {}
+        self._cells = None
+        self.cell_shifts.cache_clear()
+        if isinstance(self._buffer, mmap.mmap):
+            try:
+                self._buffer.close()
+            except BufferError:
+                # Someone still holds a shift array, let the garbage collector finish the job.
+                pass
+        self._buffer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self.subgrids)
+
+    def __iter__(self):
+        return iter(self.subgrids)
+
+    @property
+    def roots(self):
+        return [subgrid for subgrid in self.subgrids if subgrid.is_root]
+
+    def subgrid(self, name):
+        for subgrid in self.subgrids:
+            if subgrid.name == name:
+                return subgrid
+        raise KeyError(name)
+
+    def crop(self, west, south, east, north):
+        """Copies of the parts of the subgrids that cover an extent in degrees, in file order.
+
+        Subgrids that don't overlap the extent are left out. As a parent covers its children,
+        a child is only kept when its parent is.
+        """
+        cropped = []
+        for subgrid in self.subgrids:
+            part = subgrid.crop(west, south, east, north)
+            if part is not None:
+                cropped.append(part)
+        return cropped
+
+    def find_subgrids(self, lon_w, lat):
+        """Index into self.subgrids of the finest subgrid containing each point, or -1 when outside the grid.
+
+        Coordinates are arc-seconds with positive west longitudes. Points are found among the
+        roots first, then among the children of the subgrid they're in, and so on down the tree.
+        """
+        shape = np.shape(lat)
+        lon_w = np.asarray(lon_w, dtype=np.float64).ravel()
+        lat = np.asarray(lat, dtype=np.float64).ravel()
+        index = np.full(lat.shape, -1, dtype=np.intp)
+        pending = [(-1, np.arange(lat.size))] if -1 in self._index else []
+        while pending:
+            parent, points = pending.pop()
+            found = self._index[parent].lookup(lon_w[points], lat[points])
+            inside = found >= 0
+            points, found = points[inside], found[inside]
+            index[points] = found
+            for child in np.unique(found):
+                if child in self._index:
+                    pending.append((child, points[found == child]))
+        return index.reshape(shape)
+
+    def find_subgrid(self, lon_w, lat):
+        """Index into self.subgrids of the finest subgrid containing a single point, or -1 when outside the grid."""
+        found = -1
+        index = self._index.get(-1)
+        while index is not None:
+            position = index.find(lon_w, lat)
+            if position < 0:
+                break
+            found = position
+            index = self._index.get(position)
+        return found
+
+    def _build_index(self):
+        """An index of the children of each subgrid with children, and of the roots under -1."""
+        positions = dict((id(subgrid), i) for i, subgrid in enumerate(self.subgrids))
+        self._index = {}
+        for parent, children in [(-1, self.roots)] + [(positions[id(subgrid)], subgrid.children) for subgrid in self.subgrids]:
+            if children:
+                self._index[parent] = SubgridIndex(children, [positions[id(child)] for child in children])
+        self._cells = None
+
+    def _build_cells(self):
+        """Arrays for finding the cell each point is in, in any subgrid, and whether a child touches it.
+
+        Returns the e_long, s_lat, long_inc, lat_inc, cols and rows of each subgrid, the offset of
+        its first cell in the flattened cells of all of them, and a mask of those cells that are
+        clear of every child, where a point can only be in that subgrid.
+        """
+        if self._cells is None:
+            header = np.array([(subgrid.e_long, subgrid.s_lat, subgrid.long_inc, subgrid.lat_inc, subgrid.cols, subgrid.rows)
+                               for subgrid in self.subgrids], dtype=np.float64).reshape(-1, 6)
+            sizes = [max(subgrid.rows - 1, 1) * max(subgrid.cols - 1, 1) for subgrid in self.subgrids]
+            offsets = np.cumsum([0] + sizes)
+            clear = np.ones(offsets[-1], dtype=bool)
+            for i, subgrid in enumerate(self.subgrids):
+                cells = clear[offsets[i]:offsets[i + 1]].reshape(max(subgrid.rows - 1, 1), max(subgrid.cols - 1, 1))
+                for child in subgrid.children:
+                    # Generously, so that rounding never leaves a cell a child touches marked clear
+                    col_0 = int(math.floor((child.e_long - subgrid.e_long) / subgrid.long_inc)) - 1
+                    col_1 = int(math.ceil((child.w_long - subgrid.e_long) / subgrid.long_inc)) + 1
+                    row_0 = int(math.floor((child.s_lat - subgrid.s_lat) / subgrid.lat_inc)) - 1
+                    row_1 = int(math.ceil((child.n_lat - subgrid.s_lat) / subgrid.lat_inc)) + 1
+                    cells[max(row_0, 0):max(row_1, 0) + 1, max(col_0, 0):max(col_1, 0) + 1] = False
+            self._cells = header.T, offsets[:-1], clear
+        return self._cells
+
+    def _still_in(self, lon_w, lat, index):
+        """Mask of the points that are certainly still in the subgrids at index, strictly inside them and clear of their children."""
+        (e_long, s_lat, long_inc, lat_inc, cols, rows), offsets, clear = self._build_cells()
+        e_long, s_lat, long_inc, lat_inc = e_long[index], s_lat[index], long_inc[index], lat_inc[index]
+        cols, rows = cols[index], rows[index]
+        x = (lon_w - e_long) / long_inc
+        y = (lat - s_lat) / lat_inc
+        inside = (x > 0) & (x < cols - 1) & (y > 0) & (y < rows - 1)
+        col = np.clip(np.floor(np.where(inside, x, 0)).astype(np.intp), 0, np.maximum(cols - 2, 0).astype(np.intp))
+        row = np.clip(np.floor(np.where(inside, y, 0)).astype(np.intp), 0, np.maximum(rows - 2, 0).astype(np.intp))
+        return inside & clear[offsets[index] + row * np.maximum(cols - 1, 1).astype(np.intp) + col]
+
+    def interpolate(self, lon, lat):
+        """Bilinear (lat, lon) shifts in arc-seconds for arrays of lon/lat in degrees.
+
+        Longitude shifts are positive west, as stored in the grid. Points outside the grid get NaN.
+        """
+        lon = np.asarray(lon, dtype=np.float64)
+        lat = np.asarray(lat, dtype=np.float64)
+        lon_w = lon * -3600.0
+        lat_s = lat * 3600.0
+        return self._interpolate(lon_w, lat_s, self.find_subgrids(lon_w, lat_s))
+
+    def _interpolate(self, lon_w, lat_s, index):
+        """Interpolate the shifts at points (arc-seconds, positive west) in the subgrids at index."""
+        dlat = np.full(lat_s.shape, np.nan)
+        dlon = np.full(lat_s.shape, np.nan)
+        subgrids = np.unique(index)
+        if subgrids.size <= SORT_SUBGRIDS:
+            for i in subgrids:
+                if i < 0:
+                    continue
+                points = index == i
+                dlat[points], dlon[points] = self.subgrids[i].interpolate(lon_w[points], lat_s[points])
+            return dlat, dlon
+
+        # Across many subgrids, sorting the points once is quicker than a mask for each subgrid
+        order = np.argsort(index, axis=None, kind='stable')
+        index = index.ravel()[order]
+        starts = np.flatnonzero(np.diff(index)) + 1
+        lon_w, lat_s = lon_w.ravel(), lat_s.ravel()
+        flat_dlat, flat_dlon = dlat.reshape(-1), dlon.reshape(-1)
+        for start, end in zip(np.r_[0, starts], np.r_[starts, index.size]):
+            if index[start] < 0:
+                continue
+            points = order[start:end]
+            flat_dlat[points], flat_dlon[points] = self.subgrids[index[start]].interpolate(lon_w[points], lat_s[points])
+        return dlat, dlon
+
+    def _cell_shifts(self, position, row, col):
+        """The (lat, lon) shifts at the corners of a cell of a subgrid, as the lower left, lower right, upper left and upper right."""
+        subgrid = self.subgrids[position]
+        row_1 = min(row + 1, subgrid.rows - 1)
+        col_1 = min(col + 1, subgrid.cols - 1)
+        return tuple(map(tuple, subgrid.data[[row, row, row_1, row_1], [col, col_1, col, col_1], :2].tolist()))
+
+    def interpolate_point(self, lon, lat):
+        """The bilinear (lat, lon) shift in arc-seconds at a single lon/lat in degrees, or None outside the grid.
+
+        The shifts at the corners of recently used cells are cached, so points close together
+        only read the grid once.
+        """
+        lon_w = lon * -3600.0
+        lat_s = lat * 3600.0
+        position = self.find_subgrid(lon_w, lat_s)
+        if position < 0:
+            return None
+        subgrid = self.subgrids[position]
+        x = (lon_w - subgrid.e_long) / subgrid.long_inc
+        y = (lat_s - subgrid.s_lat) / subgrid.lat_inc
+        col = min(max(int(math.floor(x)), 0), max(subgrid.cols - 2, 0))
+        row = min(max(int(math.floor(y)), 0), max(subgrid.rows - 2, 0))
+        fx = x - col
+        fy = y - row
+        lower_left, lower_right, upper_left, upper_right = self.cell_shifts(position, row, col)
+        shifts = []
+        for band in (0, 1):
+            lower = lower_left[band] * (1.0 - fx) + lower_right[band] * fx
+            upper = upper_left[band] * (1.0 - fx) + upper_right[band] * fx
+            shifts.append(lower * (1.0 - fy) + upper * fy)
+        return shifts[0], shifts[1]
+
+    def shift_point(self, lon, lat, inverse=False):
+        """Apply the grid to a single lon/lat in degrees, the same way as shift. Outside the grid gives NaN."""
+        if not inverse:
+            shifts = self.interpolate_point(lon, lat)
+            if shifts is None:
+                return math.nan, math.nan
+            return lon - shifts[1] / 3600.0, lat + shifts[0] / 3600.0
+
+        # The same iteration as inverse, for one point
+        out_lon, out_lat = lon, lat
+        for i in range(INVERSE_MAX_ITERATIONS):
+            shifts = self.interpolate_point(out_lon, out_lat)
+            if shifts is None:
+                return math.nan, math.nan
+            next_lon = lon + shifts[1] / 3600.0
+            next_lat = lat - shifts[0] / 3600.0
+            converged = max(abs(next_lon - out_lon), abs(next_lat - out_lat))
+            out_lon, out_lat = next_lon, next_lat
+            if converged < INVERSE_TOLERANCE:
+                break
+        return out_lon, out_lat
+
+    def shift(self, lon, lat, inverse=False):
+        """Apply the grid to arrays of lon/lat in degrees, returning the shifted lon/lat.
+
+        The forward direction goes from the grid's SYSTEM_F to SYSTEM_T. The inverse is
+        solved iteratively with inverse. Points outside the grid get NaN.
+        """
+        lon = np.asarray(lon, dtype=np.float64)
+        lat = np.asarray(lat, dtype=np.float64)
+        if not inverse:
+            dlat, dlon = self.interpolate(lon, lat)
+            return lon - dlon / 3600.0, lat + dlat / 3600.0
+        result = self.inverse(lon, lat)
+        return result.lon, result.lat
+
+    def inverse(self, lon, lat, tolerance=INVERSE_TOLERANCE, max_iterations=INVERSE_MAX_ITERATIONS):
+        """Find the lon/lat in degrees that the grid shifts onto each of arrays of lon/lat, as an InverseResult.
+
+        This is the same fixed point iteration PROJ uses, on every point at once. A point is
+        done once it moves less than tolerance degrees in an iteration, and only the points
+        still moving are interpolated again, so a few slow ones don't hold up the rest. Since
+        points no longer take the extra iterations the slowest point needs, results aren't
+        bit-for-bit the same as iterating the whole array, but they agree within 1e-12 degrees.
+        """
+        lon, lat = np.broadcast_arrays(np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64))
+        shape = lat.shape
+        lon = lon.ravel()
+        lat = lat.ravel()
+        out_lon = lon.copy()
+        out_lat = lat.copy()
+        iterations = np.zeros(lat.shape, dtype=np.int32)
+        converged = np.zeros(lat.shape, dtype=bool)
+        active = np.arange(lat.size)
+        index = None
+        for i in range(max_iterations):
+            if not active.size:
+                break
+            lon_w = out_lon[active] * -3600.0
+            lat_s = out_lat[active] * 3600.0
+            if index is None:
+                index = self.find_subgrids(lon_w, lat_s)
+            else:
+                # Points move very little between iterations, so most are still in the same subgrid
+                # and only the others have to be looked up again
+                recheck = ~self._still_in(lon_w, lat_s, index)
+                index[recheck] = self.find_subgrids(lon_w[recheck], lat_s[recheck])
+            dlat, dlon = self._interpolate(lon_w, lat_s, index)
+            next_lon = lon[active] + dlon / 3600.0
+            next_lat = lat[active] - dlat / 3600.0
+            moved = np.maximum(np.abs(next_lon - out_lon[active]), np.abs(next_lat - out_lat[active]))
+            out_lon[active] = next_lon
+            out_lat[active] = next_lat
+            iterations[active] += 1
+            done = moved < tolerance
+            converged[active[done]] = True
+            # Points that have left the grid are NaN, and can't go any further
+            going = ~done & np.isfinite(moved)
+            active = active[going]
+            index = index[going]
+        return InverseResult(out_lon.reshape(shape), out_lat.reshape(shape), iterations.reshape(shape), converged.reshape(shape))
+
+    def _detect_byte_order(self):
+        if len(self._buffer) < RECORD_LENGTH * OVERVIEW_RECORDS:
+            raise NTv2Error("File is too short to be an NTv2 grid")
+        if bytes(self._buffer[0:8]).strip().upper() != b'NUM_OREC':
+            raise NTv2Error("File doesn't start with an NTv2 overview header")
+        for byte_order in ('<', '>'):
+            if struct.unpack_from(byte_order + 'i', self._buffer, 8)[0] == OVERVIEW_RECORDS:
+                return byte_order
+        raise NTv2Error("Unable to determine the byte order of the grid")
+
+    def _read_records(self, offset, count):
+        records = {}
+        for i in range(count):
+            start = offset + i * RECORD_LENGTH
+            key = bytes(self._buffer[start:start + 8]).decode('ascii', 'replace').strip().upper()
+            records[key] = start + 8
+        return records
+
+    def _int(self, offset):
+        return struct.unpack_from(self.byte_order + 'i', self._buffer, offset)[0]
+
+    def _double(self, offset):
+        return struct.unpack_from(self.byte_order + 'd', self._buffer, offset)[0]
+
+    def _string(self, offset):
+        return bytes(self._buffer[offset:offset + 8]).decode('ascii', 'replace').strip()
+
+    def _parse(self):
+        self.byte_order = self._detect_byte_order()
+        overview = self._read_records(0, OVERVIEW_RECORDS)
+        try:
+            self.num_subgrids = self._int(overview['NUM_FILE'])
+            self.gs_type = self._string(overview['GS_TYPE']).upper()
+            self.version = self._string(overview['VERSION'])
+            self.system_from = self._string(overview['SYSTEM_F'])
+            self.system_to = self._string(overview['SYSTEM_T'])
+            self.major_from = self._double(overview['MAJOR_F'])
+            self.minor_from = self._double(overview['MINOR_F'])
+            self.major_to = self._double(overview['MAJOR_T'])
+            self.minor_to = self._double(overview['MINOR_T'])
+        except KeyError as e:
+            raise NTv2Error("Overview header is missing record {}".format(e))
+        if self.gs_type not in GS_TYPES:
+            raise NTv2Error("Unsupported GS_TYPE {}".format(self.gs_type))
+        to_seconds = GS_TYPES[self.gs_type]
+        dtype = np.dtype(self.byte_order + 'f4')
+
+        offset = RECORD_LENGTH * OVERVIEW_RECORDS
+        for i in range(self.num_subgrids):
+            header = self._read_records(offset, SUBGRID_RECORDS)
+            try:
+                count = self._int(header['GS_COUNT'])
+                data_offset = offset + RECORD_LENGTH * SUBGRID_RECORDS
+                data_length = count * NODE_VALUES * dtype.itemsize
+                if data_offset + data_length > len(self._buffer):
+                    raise NTv2Error("Subgrid {} runs past the end of the file".format(i))
+                data = np.frombuffer(self._buffer, dtype=dtype, count=count * NODE_VALUES, offset=data_offset)
+                subgrid = SubGrid(
+                    self._string(header['SUB_NAME']),
+                    self._string(header['PARENT']),
+                    self._string(header['CREATED']),
+                    self._string(header['UPDATED']),
+                    self._double(header['S_LAT']) * to_seconds,
+                    self._double(header['N_LAT']) * to_seconds,
+                    self._double(header['E_LONG']) * to_seconds,
+                    self._double(header['W_LONG']) * to_seconds,
+                    self._double(header['LAT_INC']) * to_seconds,
+                    self._double(header['LONG_INC']) * to_seconds,
+                    count,
+                    data
+                )
+            except KeyError as e:
+                raise NTv2Error("Subgrid {} header is missing record {}".format(i, e))
+            self.subgrids.append(subgrid)
+            offset = data_offset + data_length
+        self.data_end = offset
+
+        # Link children to their parents, keeping the file order.
+        by_name = dict((subgrid.name, subgrid) for subgrid in self.subgrids)
+        for subgrid in self.subgrids:
+            if not subgrid.is_root:
+                parent = by_name.get(subgrid.parent)
+                if parent is None:
+                    raise NTv2Error("Subgrid {} has unknown parent {}".format(subgrid.name, subgrid.parent))
+                parent.children.append(subgrid)
+
+    def __repr__(self):
+        return "NTv2Grid({!r}, subgrids={})".format(self.path, len(self.subgrids))
+
+
+def _record(key, byte_order, value):
+    if isinstance(value, int):
+        packed = struct.pack(byte_order + 'i', value) + b'\0' * 4
+    elif isinstance(value, float):
+        packed = struct.pack(byte_order + 'd', value)
+    else:
+        packed = value.encode('ascii', 'replace')[:8].ljust(8)
+    return key.encode('ascii').ljust(8) + packed
+
+
+def write_grid(path, subgrids, system_from='', system_to='', major_from=6378137.0, minor_from=6356752.314,
+               major_to=6378137.0, minor_to=6356752.314, byte_order='<'):
+    """Write SubGrids to an NTv2 file, with the shifts in arc-seconds.
+
+    Subgrids are written in the order given, so parents should come before their children.
+    The file is written next to path and then moved into place, so a reader never sees half
+    of it.
+    """
+    handle, part_file = tempfile.mkstemp(suffix='.part', prefix=os.path.basename(path) + '.', dir=os.path.dirname(path) or '.')
+    with os.fdopen(handle, 'wb') as f:
+        f.write(b''.join([
+            _record('NUM_OREC', byte_order, OVERVIEW_RECORDS),
+            _record('NUM_SREC', byte_order, SUBGRID_RECORDS),
+            _record('NUM_FILE', byte_order, len(subgrids)),
+            _record('GS_TYPE', byte_order, 'SECONDS'),
+            _record('VERSION', byte_order, 'NTv2.0'),
+            _record('SYSTEM_F', byte_order, system_from),
+            _record('SYSTEM_T', byte_order, system_to),
+            _record('MAJOR_F', byte_order, float(major_from)),
+            _record('MINOR_F', byte_order, float(minor_from)),
+            _record('MAJOR_T', byte_order, float(major_to)),
+            _record('MINOR_T', byte_order, float(minor_to)),
+        ]))
+        for subgrid in subgrids:
+            f.write(b''.join([
+                _record('SUB_NAME', byte_order, subgrid.name),
+                _record('PARENT', byte_order, subgrid.parent),
+                _record('CREATED', byte_order, subgrid.created),
+                _record('UPDATED', byte_order, subgrid.updated),
+                _record('S_LAT', byte_order, float(subgrid.s_lat)),
+                _record('N_LAT', byte_order, float(subgrid.n_lat)),
+                _record('E_LONG', byte_order, float(subgrid.e_long)),
+                _record('W_LONG', byte_order, float(subgrid.w_long)),
+                _record('LAT_INC', byte_order, float(subgrid.lat_inc)),
+                _record('LONG_INC', byte_order, float(subgrid.long_inc)),
+                _record('GS_COUNT', byte_order, subgrid.rows * subgrid.cols),
+            ]))
+            f.write(np.ascontiguousarray(subgrid.data, dtype=byte_order + 'f4').tobytes())
+        f.write(b'END'.ljust(RECORD_LENGTH))
+    os.replace(part_file, path)
+    return path
+
+
+def crop_grid(path, out_path, west, south, east, north):
+    """Write the part of the grid at path that covers an extent in degrees to out_path.
+
+    Returns out_path, or None if the grid doesn't cover any of the extent.
+    """
+    with NTv2Grid.open(path) as grid:
+        subgrids = grid.crop(west, south, east, north)
+        if not subgrids:
+            return None
+        return write_grid(out_path, subgrids, grid.system_from, grid.system_to, grid.major_from, grid.minor_from,
+                          grid.major_to, grid.minor_to, grid.byte_order)
+
+
+def validate_grid(path):
+    """Check that a file is a complete NTv2 grid, raising NTv2Error if it isn't."""
+    with NTv2Grid.open(path) as grid:
+        end = bytes(grid._buffer[grid.data_end:grid.data_end + 8]).strip().upper()
+        if end != b'END':
+            raise NTv2Error("Grid is truncated, there's no END record after the last subgrid")
+
+
+# Grids that have been opened in this process, keyed by path.
+_OPEN_GRIDS = {}
+
+
+@lru_cache(maxsize=256)
+def _realpath(path):
+    # Resolving the path is most of the time it takes to find an open grid for a single point
+    return os.path.realpath(path)
+
+
+def open_grid(path):
+    """Open an NTv2 grid, reusing an already parsed grid if the file hasn't changed."""
+    path = _realpath(path)
+    mtime = os.path.getmtime(path)
+    cached = _OPEN_GRIDS.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    if cached:
+        cached[1].close()
+    grid = NTv2Grid.open(path)
+    _OPEN_GRIDS[path] = (mtime, grid)
+    return grid
+
+
+def close_grids():
+    for mtime, grid in _OPEN_GRIDS.values():
+        grid.close()
+    _OPEN_GRIDS.clear()
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ probe
+                                 A QGIS plugin
+ This plugin uses official ICSM grids to transform between Australian coordinate systems.
+                              -------------------
+        begin                : 2017-01-08
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Alex Leith
+        email                : alex@auspatious.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+ Cheap inspection of input files.
+
+ A file is opened once, with a single GDAL driver probe for both vector and
+ raster drivers, and what we need to know about it is cached by path and
+ modification time. This keeps the dialog responsive on network shares.
+"""
+
+import os
+import os.path
+import threading
+from collections import OrderedDict, namedtuple
+
+from osgeo import gdal
+
+from qgis.core import QgsCoordinateReferenceSystem
+
+# file_type is 'VECTOR' or 'RASTER', crs is the authid, extent is (xmin, ymin, xmax, ymax)
+# or None, and feature_count is None for rasters or when counting would mean a full scan.
+Probe = namedtuple('Probe', ['file_type', 'crs', 'extent', 'feature_count'])
+
+PROBE_CACHE_SIZE = 64
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _authid(wkt):
+    if not wkt:
+        return ''
+    # Match the CRS the same way QGIS does when it opens the layer
+    return QgsCoordinateReferenceSystem.fromWkt(wkt).authid()
+
+
+def _probe(file_name):
+    dataset = gdal.OpenEx(file_name, gdal.OF_VECTOR | gdal.OF_RASTER | gdal.OF_READONLY)
+    if dataset is None:
+        return None
+
+    if dataset.GetLayerCount() > 0:
+        layer = dataset.GetLayer(0)
+        srs = layer.GetSpatialRef()
+        # Don't force a scan of the whole file for these, if the driver doesn't know them they stay unknown
+        extent = layer.GetExtent(force=0, can_return_null=1)
+        if extent:
+            extent = (extent[0], extent[2], extent[1], extent[3])
+        feature_count = layer.GetFeatureCount(force=0)
+        return Probe('VECTOR', _authid(srs.ExportToWkt() if srs else None), extent,
+                     feature_count if feature_count >= 0 else None)
+
+    if dataset.RasterCount > 0:
+        x, x_size, __, y, __, y_size = dataset.GetGeoTransform()
+        xs = (x, x + x_size * dataset.RasterXSize)
+        ys = (y, y + y_size * dataset.RasterYSize)
+        return Probe('RASTER', _authid(dataset.GetProjection()), (min(xs), min(ys), max(xs), max(ys)), None)
+
+    return None
+
+
+def probe_file(file_name):
+    """Find out whether a file is a vector or raster, and its CRS, extent and feature count.
+
+    Returns a Probe, or None if the file can't be read. Results are cached until the file changes.
+    """
+    try:
+        stat = os.stat(file_name)
+    except OSError:
+        return None
+    key = (os.path.realpath(file_name), stat.st_mtime, stat.st_size)
+
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+
+    result = _probe(file_name)
+
+    with _cache_lock:
+        _cache[key] = result
+        while len(_cache) > PROBE_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return result
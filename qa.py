@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ qa
+                                 A QGIS plugin
+ This plugin uses official ICSM grids to transform between Australian coordinate systems.
+                              -------------------
+        begin                : 2017-01-08
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Alex Leith
+        email                : alex@auspatious.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+ Round trip checks of a transform over a dataset's extent.
+
+ Points are sampled across the extent, a few in each cell of a regular
+ lattice so the whole extent is covered, transformed forward and back again
+ in one batch, and the distance between where they started and where they
+ came back is reported. The forward leg can be run by the engine that wrote
+ the output, such as PROJ, and the way back by the grid reader here, so the
+ check compares the two. A transform that doesn't return points to within
+ the tolerance points at a damaged, mismatched or missing grid. A thousand points take a
+ few milliseconds, so this runs after every job. Nothing here needs QGIS.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+from .coordinates import ELLIPSOIDS, coordinate_systems, transform_coordinates
+from .transforms import reverse
+
+# Points sampled from each dataset
+QA_POINTS = 1000
+# Largest acceptable round trip residual, in metres
+QA_TOLERANCE = 0.001
+# The extent is divided into this many cells each way, and the points spread evenly over them
+QA_CELLS = 4
+# Number of the worst points kept in a result
+MAX_REPORTED = 20
+
+# Residuals are in metres. outside is the number of points that fell outside the grid, and
+# aren't in the statistics. failures is a list of (x, y, residual) in the source CRS for the
+# worst of the points over the tolerance, worst first, and failed is how many there were.
+QAResult = namedtuple('QAResult', ['points', 'outside', 'mean', 'rms', 'p95', 'max', 'tolerance', 'failed', 'failures'])
+
+
+def sample_points(extent, count=QA_POINTS, cells=QA_CELLS, seed=0):
+    """Arrays of x and y for about count random points spread evenly over the cells of an extent."""
+    xmin, ymin, xmax, ymax = extent
+    per_cell = max(1, int(np.ceil(float(count) / (cells * cells))))
+    random = np.random.RandomState(seed)
+    col, row = np.meshgrid(np.arange(cells), np.arange(cells))
+    col = np.repeat(col.ravel(), per_cell)
+    row = np.repeat(row.ravel(), per_cell)
+    x = xmin + (xmax - xmin) * (col + random.random_sample(col.size)) / cells
+    y = ymin + (ymax - ymin) * (row + random.random_sample(row.size)) / cells
+    return x, y
+
+
+def _metres(system, x, y, x2, y2):
+    """Distances in metres between points in a coordinate system."""
+    if system.projection:
+        return np.hypot(x2 - x, y2 - y)
+    # Radii of curvature of the ellipsoid, to turn small differences in degrees into metres
+    a, inverse_flattening = ELLIPSOIDS[system.ellipsoid]
+    f = 1.0 / inverse_flattening
+    e2 = f * (2.0 - f)
+    sin_lat = np.sin(np.radians(y))
+    w = np.sqrt(1.0 - e2 * sin_lat ** 2)
+    meridian = a * (1.0 - e2) / w ** 3
+    prime_vertical = a / w
+    return np.hypot(np.radians(x2 - x) * prime_vertical * np.cos(np.radians(y)), np.radians(y2 - y) * meridian)
+
+
+def round_trip(transform, extent, count=QA_POINTS, tolerance=QA_TOLERANCE, cells=QA_CELLS, seed=0, forward=None):
+    """Transform points sampled over an extent in the source CRS forward and back, and measure how far off they come back.
+
+    forward is called with arrays of x and y in the source CRS and returns them in the target
+    CRS, with failed points not finite. It defaults to transform_coordinates, whose inverse is
+    solved from the same interpolation, so it only shows up a grid that's damaged. Points that
+    are inside the grid but that forward can't transform are failures, with an infinite residual.
+    Returns a QAResult, or None if there's no extent to sample.
+    """
+    if extent is None or count <= 0:
+        return None
+    x, y = sample_points(extent, count, cells, seed)
+    expected_x, expected_y = transform_coordinates(transform, x, y)
+    if forward is None:
+        forward_x, forward_y = expected_x, expected_y
+    else:
+        forward_x, forward_y = (np.asarray(values, dtype=np.float64) for values in forward(x, y))
+        placed = np.isfinite(forward_x) & np.isfinite(forward_y)
+        forward_x, forward_y = np.where(placed, forward_x, np.nan), np.where(placed, forward_y, np.nan)
+    back_x, back_y = transform_coordinates(reverse(transform), forward_x, forward_y)
+    residual = _metres(coordinate_systems(transform)[0], x, y, back_x, back_y)
+
+    inside = np.isfinite(expected_x) & np.isfinite(expected_y)
+    residual = np.where(inside & ~np.isfinite(residual), np.inf, residual)
+    measured = residual[inside]
+    if not measured.size:
+        return QAResult(x.size, x.size, None, None, None, None, tolerance, 0, [])
+
+    failed = np.flatnonzero(np.where(inside, residual, 0.0) > tolerance)
+    worst = failed[np.argsort(residual[failed])[::-1][:MAX_REPORTED]]
+    with np.errstate(invalid='ignore'):
+        p95 = np.percentile(measured, 95)
+    return QAResult(
+        points=x.size,
+        outside=int(x.size - measured.size),
+        mean=float(np.mean(measured)),
+        rms=float(np.sqrt(np.mean(measured ** 2))),
+        # Between a finite residual and an infinite one the percentile is NaN, and it's infinite
+        p95=float(np.inf if np.isnan(p95) else p95),
+        max=float(np.max(measured)),
+        tolerance=tolerance,
+        failed=int(failed.size),
+        failures=[(float(x[i]), float(y[i]), float(residual[i])) for i in worst],
+    )
+
+
+def summary(result):
+    """A line describing a QAResult, for logs and the dialog."""
+    if result is None:
+        return "Round trip check skipped, no extent"
+    if result.max is None:
+        return "Round trip check: all {} points are outside the grid".format(result.points)
+    line = "Round trip check of {} points: max {:.2e} m, rms {:.2e} m, 95% {:.2e} m".format(
+        result.points - result.outside, result.max, result.rms, result.p95)
+    if result.outside:
+        line += ", {} outside the grid".format(result.outside)
+    if result.failed:
+        x, y, residual = result.failures[0]
+        line += ". {} over the {} m tolerance, the worst {:.3f} m at ({:.6f}, {:.6f})".format(
+            result.failed, result.tolerance, residual, x, y)
+    return line
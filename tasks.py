@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ tasks
+                                 A QGIS plugin
+ This plugin uses official ICSM grids to transform between Australian coordinate systems.
+                              -------------------
+        begin                : 2017-01-08
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Alex Leith
+        email                : alex@auspatious.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+ Background tasks for the QGIS task manager, so that grid downloads and
+ transformations don't block the interface. They only need a QgsApplication,
+ not the plugin dialog.
+"""
+
+import os.path
+
+from qgis.core import QgsTask
+
+from .download import DownloadCancelled
+from .engine import (DEFAULT_WARP, QA_POINTS, TransformError, check_round_trip, crop_transform, dataset_extent, ensure_grid, log, open_input,
+                     transform_raster_by_zone, transform_raster_file)
+from .timing import Timer
+from .vectors import stream_vector_file, transform_vector_by_zone, transform_vector_file
+
+# Share of the progress bar given to downloading the grid, when it's needed
+DOWNLOAD_PROGRESS = 0.2
+
+
+class TransformTask(QgsTask):
+    """Downloads the grid a transform needs, if it's missing, then transforms a file.
+
+    on_finished is called on the main thread with the task and whether it succeeded. After
+    that, out_files and in_file_type describe the output, and error holds the reason for a
+    failure. With by_zone, each feature or raster is written in the UTM zone it falls in, so
+    there can be several output files. out_format is a key of the engine's VECTOR_FORMATS or
+    RASTER_FORMATS, to suit the in file, and rasters are warped with the WarpSettings warp.
+    With stream, and without by_zone, a vector file is read and written a batch at a time, and an interrupted job
+    resumes where it stopped. Each stage is timed by timer, and logged as it finishes. Once
+    the file is written, qa_points points over its extent are sent through the transform and
+    back again, and qa holds the result of the check, if there was one. transform_context is the
+    project's QgsCoordinateTransformContext, which has to be read on the main thread, when the
+    task is made, as the project can't be used from the worker thread.
+    """
+
+    def __init__(self, transform, in_file, out_file, on_finished=None, by_zone=False, out_format=None, qa_points=QA_POINTS,
+                 warp=DEFAULT_WARP, stream=False, transform_context=None):
+        super(TransformTask, self).__init__("Transforming {}".format(os.path.basename(in_file)), QgsTask.CanCancel)
+        self.transform = transform
+        self.in_file = in_file
+        self.out_file = out_file
+        self.on_finished = on_finished
+        self.by_zone = by_zone
+        self.out_format = out_format
+        self.qa_points = qa_points
+        self.warp = warp
+        self.stream = stream
+        self.transform_context = transform_context
+        self.qa = None
+        self.out_files = []
+        self.in_file_type = None
+        self.error = None
+        self.timer = Timer(os.path.basename(in_file), on_span=lambda span: log("{}: {}".format(self.timer.job, span)))
+
+    def _progress(self, start, end):
+        """A progress callback for the engine, mapped onto part of the task's progress."""
+        def progress(complete, message=None):
+            self.setProgress(100.0 * (start + (end - start) * complete))
+            return not self.isCanceled()
+        return progress
+
+    def run(self):
+        # The task manager runs this on a worker thread, so it must not raise, or touch the interface.
+        try:
+            start = 0.0
+            if self.transform.grid and not os.path.isfile(self.transform.grid):
+                download_progress = self._progress(0.0, DOWNLOAD_PROGRESS)
+                if not ensure_grid(self.transform.grid, lambda received, total: download_progress(float(received) / total if total else 0.0),
+                                   self.timer):
+                    self.error = "Failed to download transformation grid. Check your network connection and try again."
+                    return False
+                start = DOWNLOAD_PROGRESS
+            else:
+                # Record that the grid was used, so it isn't the first to go from a full grid directory
+                ensure_grid(self.transform.grid, timer=self.timer)
+            if self.isCanceled():
+                return False
+
+            # Datasets can't be shared between threads, so open the input again here
+            self.in_file_type, dataset, __ = open_input(self.in_file, self.timer)
+            # Only read the part of the grid that covers the data
+            extent = dataset_extent(self.in_file_type, dataset)
+            transform = crop_transform(self.transform, extent, self.timer)
+            progress = self._progress(start, 1.0)
+            if self.stream and self.in_file_type == 'VECTOR' and not self.by_zone:
+                self.out_files = [stream_vector_file(
+                    transform, self.in_file, self.out_file, progress=progress, out_format=self.out_format, timer=self.timer)]
+            elif self.by_zone and self.in_file_type == 'VECTOR':
+                self.out_files = transform_vector_by_zone(
+                    transform, dataset, self.out_file, progress=progress, out_format=self.out_format, timer=self.timer,
+                    context=self.transform_context)
+            elif self.by_zone:
+                self.out_files = transform_raster_by_zone(
+                    transform, dataset, self.out_file, progress=progress, out_format=self.out_format, timer=self.timer,
+                    warp=self.warp)
+            elif self.in_file_type == 'VECTOR':
+                self.out_files = [transform_vector_file(
+                    transform, dataset, self.out_file, progress=progress, out_format=self.out_format, timer=self.timer,
+                    context=self.transform_context)]
+            else:
+                self.out_files = [transform_raster_file(
+                    transform, dataset, self.out_file, progress=progress, out_format=self.out_format, timer=self.timer,
+                    warp=self.warp)]
+            dataset = None
+
+            if not self.isCanceled():
+                self.qa = check_round_trip(transform, extent, self.qa_points, job=self.timer.job, timer=self.timer)
+        except DownloadCancelled:
+            # finished reports the cancellation
+            return False
+        except TransformError as e:
+            self.error = str(e)
+            return False
+        except Exception as e:
+            log("Unexpected error transforming {}: {}".format(self.in_file, e), True)
+            self.error = "Unexpected error: {}".format(e)
+            return False
+        return not self.isCanceled()
+
+    def finished(self, result):
+        if self.isCanceled() and not self.error:
+            self.error = "Transformation cancelled"
+        if self.on_finished:
+            self.on_finished(self, result)
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ timing
+                                 A QGIS plugin
+ This plugin uses official ICSM grids to transform between Australian coordinate systems.
+                              -------------------
+        begin                : 2017-01-08
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Alex Leith
+        email                : alex@auspatious.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+ Timing of the stages of a job.
+
+ Each stage of a transformation (probing the input, building the CRSs,
+ fetching the grid, writing the output, adding the layer) is wrapped in a
+ span, which records how long it took along with counts such as features,
+ pixels and bytes written. A span costs a couple of clock reads, so timing is
+ always on. The spans of a job can be exported as JSON, and the totals of
+ many jobs as a Prometheus style metrics file. Nothing here needs QGIS.
+"""
+
+import json
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_PREFIX = 'icsm_transformer'
+
+
+class Span(object):
+    """A timed stage. Counts are added to it while it runs."""
+
+    __slots__ = ('stage', 'start', 'seconds', 'values')
+
+    def __init__(self, stage, start, values):
+        self.stage = stage
+        self.start = start
+        self.seconds = None
+        self.values = values
+
+    def add(self, key, amount=1):
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, **values):
+        self.values.update(values)
+
+    def as_dict(self):
+        span = {'stage': self.stage, 'start': round(self.start, 6), 'seconds': round(self.seconds or 0.0, 6)}
+        span.update(self.values)
+        return span
+
+    def __str__(self):
+        values = ', '.join('{}={}'.format(key, value) for key, value in sorted(self.values.items()))
+        return "{} took {:.3f}s{}".format(self.stage, self.seconds or 0.0, ' ({})'.format(values) if values else '')
+
+
+class _NoSpan(object):
+
+    def add(self, key, amount=1):
+        pass
+
+    def set(self, **values):
+        pass
+
+
+class Timer(object):
+    """Records the spans of one job. Spans can be recorded from several threads at once.
+
+    on_span is called with each Span as it finishes, for logging.
+    """
+
+    def __init__(self, job='', on_span=None):
+        self.job = job
+        self.on_span = on_span
+        self.started = time.time()
+        self.spans = []
+        self._origin = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, stage, **values):
+        span = Span(stage, time.perf_counter() - self._origin, values)
+        try:
+            yield span
+        except BaseException as e:
+            span.values['error'] = type(e).__name__
+            raise
+        finally:
+            span.seconds = time.perf_counter() - self._origin - span.start
+            with self._lock:
+                self.spans.append(span)
+            if self.on_span:
+                self.on_span(span)
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self._origin
+
+    def totals(self):
+        """The number of spans, total seconds and summed counts of each stage."""
+        totals = {}
+        with self._lock:
+            spans = list(self.spans)
+        for span in spans:
+            total = totals.setdefault(span.stage, {'spans': 0, 'seconds': 0.0})
+            total['spans'] += 1
+            total['seconds'] += span.seconds or 0.0
+            for key, value in span.values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    total[key] = total.get(key, 0) + value
+        return totals
+
+    def as_dict(self):
+        with self._lock:
+            spans = [span.as_dict() for span in self.spans]
+        return {
+            'job': self.job,
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+            'seconds': round(self.elapsed, 6),
+            'spans': spans,
+            'totals': self.totals(),
+        }
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
+        return path
+
+
+class NoTimer(object):
+    """Stands in for a Timer when nobody wants the timings."""
+
+    @contextmanager
+    def span(self, stage, **values):
+        yield _NoSpan()
+
+
+NO_TIMER = NoTimer()
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' ')
+
+
+def metrics(jobs, prefix=METRICS_PREFIX):
+    """Lines of Prometheus text format for the stage totals of each job.
+
+    jobs is a dict of job name to the totals from Timer.totals().
+    """
+    lines = {}
+    for job, totals in sorted(jobs.items()):
+        for stage, total in sorted(totals.items()):
+            for key, value in sorted(total.items()):
+                name = '{}_stage_{}'.format(prefix, re.sub(r'[^a-zA-Z0-9_]', '_', key))
+                if key != 'seconds':
+                    name += '_total'
+                lines.setdefault(name, []).append('{}{{job="{}",stage="{}"}} {}'.format(name, _label(job), _label(stage), value))
+    output = []
+    for name, samples in sorted(lines.items()):
+        output.append('# TYPE {} {}'.format(name, 'gauge' if name.endswith('_seconds') else 'counter'))
+        output.extend(samples)
+    return output
+
+
+def write_metrics(path, jobs, prefix=METRICS_PREFIX):
+    with open(path, 'w') as f:
+        f.write('\n'.join(metrics(jobs, prefix)) + '\n')
+    return path
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ transforms
+                                 A QGIS plugin
+ This plugin uses official ICSM grids to transform between Australian coordinate systems.
+                              -------------------
+        begin                : 2017-01-08
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Alex Leith
+        email                : alex@auspatious.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+ The supported coordinate systems and the transforms between them.
+
+ Transforms are built the first time they're looked up, not at import time,
+ and are kept in a read only registry keyed by the source CRS authid.
+"""
+
+import os.path
+import re
+from collections import namedtuple
+from functools import lru_cache
+from types import MappingProxyType
+
+from .gridcache import grid_dir
+
+
+Transform = namedtuple(
+    'Transform',
+    ['name', 'source_name', 'target_name', 'source_proj', 'target_proj', 'source_code', 'target_code', 'grid', 'grid_text'],
+)
+
+# The grids are in the plugin's grids folder, unless a shared directory is set with ICSM_GRID_DIR
+GRID_DIR = grid_dir()
+AGD66GRID = os.path.join(GRID_DIR, 'A66_National_13_09_01.gsb')
+AGD84GRID = os.path.join(GRID_DIR, 'National_84_02_07_01.gsb')
+GDA2020CONF = os.path.join(GRID_DIR, 'GDA94_GDA2020_conformal.gsb')
+GDA2020CONF_DIST = os.path.join(GRID_DIR, 'GDA94_GDA2020_conformal_and_distortion.gsb')
+
+# These comments are printed in the dialog that describes the transform to be carried out.
+GRID_COMMENTS = {
+    'A66_National_13_09_01.gsb': (
+        "NTv2 transformation grid A66_national_13_09_01.gsb [EPSG:1803] <b>provides complete national coverage.</b><br>"
+        "See Appendix B of Geocentric Datum of Australia 2020 Technical Manual for grid coverage and description."
+    ),
+    'National_84_02_07_01.gsb': (
+        "NTv2 transformation grid National_84_02_07_01.gsb [EPSG:1804] <b>only has coverage for jurisdictions that adopted AGD84 - QLD, SA and WA.</b><br>"
+        "See Appendix A of Geocentric Datum of Australia 2020 Technical Manual for grid coverage and description."
+    ),
+    'GDA94_GDA2020_conformal.gsb': (
+        "NTv2 transformation grid GDA94_GDA2020_conformal.gsb [EPSG:????] <b>only applies a conformal transformation between the datums.</b><br>"
+        "See Section 3.2 of Geocentric Datum of Australia 2020 Technical Manual for a description of the grid and Section 3.7.1 for when it is appropriate to apply."
+    ),
+    'GDA94_GDA2020_conformal_and_distortion.gsb': (
+        "NTv2 transformation grid GDA94_GDA2020_conformal_and_distortion.gsb [EPSG:????] <b>applies a conformal plus distortion transformation between the datums.</b><br>"
+        "See Section 3.2 of Geocentric Datum of Australia 2020 Technical Manual for a description of the grid and Section 3.7.1 for when it is appropriate to apply."
+    )
+}
+
+# EPSGs, in code: name, utm, proj, grid
+available_epsgs = {
+    '202': {
+        "name": "AGD66 / AMG",
+        "utm": True,
+        "proj": '+proj=utm +zone={zone} +south +ellps=aust_SA +towgs84=-117.808,-51.536,137.784,0.303,0.446,0.234,-0.29 +units=m +no_defs +nadgrids=' + AGD66GRID + ' +wktext',
+        "grid": AGD66GRID
+    },
+    '203': {
+        "name": "AGD84 / AMG",
+        "utm": True,
+        "proj": '+proj=utm +zone={zone} +south +ellps=aust_SA +towgs84=-134,-48,149,0,0,0,0 +units=m +no_defs +nadgrids=' + AGD84GRID + ' +wktext',
+        "grid": AGD84GRID
+    },
+    '283': {
+        "name": "GDA94 / MGA",
+        'utm': True,
+        "proj": '+proj=utm +zone={zone} +south +ellps=GRS80 +towgs84=0,0,0,0,0,0,0 +units=m +no_defs +wktext',
+        "grid": None
+    },
+    '283c': {
+        "name": "GDA94 / MGA (Conformal only)",
+        'utm': True,
+        "proj": '+proj=utm +zone={zone} +south +ellps=GRS80 +towgs84=0,0,0,0,0,0,0 +units=m +no_defs +nadgrids=' + GDA2020CONF + ' +wktext',
+        "grid": GDA2020CONF
+    },
+    '283d': {
+        "name": "GDA94 / MGA (Conformal and distortion",
+        'utm': True,
+        "proj": '+proj=utm +zone={zone} +south +ellps=GRS80 +towgs84=0,0,0,0,0,0,0 +units=m +no_defs +nadgrids=' + GDA2020CONF_DIST + ' +wktext',
+        "grid": GDA2020CONF_DIST
+    },
+    '78c': {
+        "name": "GDA2020 / MGA (Conformal only)",
+        'utm': True,
+        "proj": '+proj=utm +zone={zone} +south +ellps=GRS80 +towgs84=0,0,0,0,0,0,0 +units=m +no_defs +wktext',
+        "grid": None
+    },
+    '78d': {
+        "name": "GDA2020 / MGA (Conformal & Distortion)",
+        'utm': True,
+        "proj": '+proj=utm +zone={zone} +south +ellps=GRS80 +towgs84=0,0,0,0,0,0,0 +units=m +no_defs +wktext',
+        "grid": None
+    },
+    '4202': {
+        "name": "AGD66 Latitude and Longitude",
+        "utm": False,
+        "proj": '+proj=longlat +ellps=aust_SA +towgs84=-117.808,-51.536,137.784,0.303,0.446,0.234,-0.29 +no_defs +nadgrids=' + AGD66GRID + ' +wktext',
+        "grid": AGD66GRID
+    },
+    '4203': {
+        "name": "AGD84 Latitude and Longitude",
+        "utm": False,
+        "proj": '+proj=longlat +ellps=aust_SA +no_defs +towgs84=-134,-48,149,0,0,0,0 +nadgrids=' + AGD84GRID + ' +wktext',
+        "grid": AGD84GRID
+    },
+    '4283': {
+        "name": "GDA94 Latitude and Longitude",
+        "utm": False,
+        "proj": None,
+        "grid": None
+    },
+    '4283c': {
+        "name": "GDA94 Latitude and Longitude (Conformal only)",
+        "utm": False,
+        "proj": '+proj=longlat +ellps=GRS80 +towgs84=0,0,0,0,0,0,0 +no_defs +nadgrids=' + GDA2020CONF + ' +wktext',
+        "grid": GDA2020CONF
+    },
+    '4283d': {
+        "name": "GDA94 Latitude and Longitude (Conformal & Distortion)",
+        "utm": False,
+        "proj": '+proj=longlat +ellps=GRS80 +towgs84=0,0,0,0,0,0,0 +no_defs +nadgrids=' + GDA2020CONF_DIST + ' +wktext',
+        "grid": GDA2020CONF_DIST
+    },
+    '7844c': {
+        "name": "GDA2020 Latitude and Longitude (Conformal only)",
+        "utm": False,
+        "proj": '+proj=longlat +ellps=GRS80 +towgs84=0,0,0,0,0,0,0 +no_defs +wktext',
+        "grid": None
+    },
+    '7844d': {
+        "name": "GDA2020 Latitude and Longitude (Conformal & Distortion)",
+        "utm": False,
+        "proj": '+proj=longlat +ellps=GRS80 +towgs84=0,0,0,0,0,0,0 +no_defs +wktext',
+        "grid": None
+    }
+}
+
+# Range makes a list from 49 to 56
+available_zones = list(range(49, 57))
+
+# transformations - a list of FROM and all available TOs
+transformations = [
+    # UTM
+    ['202', ['283']],
+    ['203', ['283']],
+    ['283', ['202', '203']],
+    ['283c', ['78c']],
+    ['283d', ['78d']],
+    ['78c', ['283c']],
+    ['78d', ['283d']],
+    # LonLat
+    ['4202', ['4283']],
+    ['4203', ['4283']],
+    ['4283', ['4202', '4203']],
+    ['4283c', ['7844c']],
+    ['4283d', ['7844d']],
+    ['7844c', ['4283c']],
+    ['7844d', ['4283d']],
+]
+
+
+def build_transform(in_info, in_crs, zone=False):
+    source_name = in_info['name']
+    source_proj = in_info['proj']
+    source_grid = in_info['grid']
+    source_epsg = in_crs[0].replace('c', '').replace('d', '')
+    source_target_epsgs = in_crs[1]
+    zone_string = ""
+    if zone:
+        zone_string = str(zone)
+
+    source_code = '{epsg}{zone}'.format(epsg=source_epsg, zone=zone_string)
+    epsg_string = 'EPSG:{}'.format(source_code)
+    name_string = "{name} [EPSG:{code}]"
+
+    if zone and source_proj:
+        source_proj = source_proj.format(zone=zone)
+
+    target_crs = []
+    for target_epsg in source_target_epsgs:
+        target_name = available_epsgs[target_epsg]['name']
+        # log("Working on {} with {}".format(source_name, target_name))
+        target_grid = available_epsgs[target_epsg]['grid']
+        target_epsg_clean = target_epsg.replace('c', '').replace('d', '')
+        target_code = '{epsg}{zone}'.format(
+            epsg=target_epsg_clean,
+            zone=zone_string
+        )
+        name = source_name.split(' ')[0] + ' to ' + target_name.split(' ')[0]
+        source = name_string.format(name=source_name, code=source_code)
+        target = name_string.format(name=target_name, code=target_code)
+        target_proj = available_epsgs[target_epsg]['proj']
+
+        if zone and target_proj:
+            target_proj = target_proj.format(zone=zone)
+
+        grid = None
+        if source_grid:
+            grid = source_grid
+        elif target_grid:
+            grid = target_grid
+        grid_text = ""
+        if grid:
+            grid_text = "using NTv2 grid: '{}'".format(os.path.basename(grid))
+            comments = GRID_COMMENTS.get(os.path.basename(grid))
+            grid_text += "<br><br>" + comments
+
+        target_crs.append(Transform(name, source, target, source_proj, target_proj, int(source_code), int(target_code), grid, grid_text))
+
+    return epsg_string, target_crs
+
+
+@lru_cache(maxsize=None)
+def supported_transforms():
+    """All the supported transforms, as a read only mapping of source authid to a tuple of Transforms.
+
+    This is built once, on first use.
+    """
+    registry = {}
+    for source_crs in transformations:
+        epsg_info = available_epsgs[source_crs[0]]
+        if epsg_info['utm']:
+            # This is a UTM crs, so process all the codes
+            zones = available_zones
+        else:
+            # Just process this one, no zones
+            zones = [False]
+        for zone in zones:
+            transform_label, transforms = build_transform(epsg_info, source_crs, zone=zone)
+            # If there's more than one transform source that is the same, the later ones go first
+            registry[transform_label] = tuple(transforms) + registry.get(transform_label, ())
+    return MappingProxyType(registry)
+
+
+def transforms_for(authid):
+    """The transforms available from a source CRS authid, such as 'EPSG:28356'. Empty if it isn't supported."""
+    return supported_transforms().get(authid, ())
+
+
+def target_datum(transform):
+    """The name of a transform's target without its EPSG code, which is the same for every zone."""
+    return transform.target_name.rsplit(' [EPSG:', 1)[0]
+
+
+def source_zone(transform):
+    """The UTM zone a transform's source is in, or None if it isn't projected."""
+    # Taken from the projection, as the codes aren't all the same length (EPSG:28355, EPSG:7855)
+    match = re.search(r'\+proj=utm\b.*?\+zone=(\d+)', transform.source_proj or '')
+    if match and int(match.group(1)) in available_zones:
+        return int(match.group(1))
+    return None
+
+
+def with_grid(transform, grid):
+    """The same transform, using another copy of its grid file, such as a cropped one."""
+    if not transform.grid or grid == transform.grid:
+        return transform
+    return transform._replace(
+        grid=grid,
+        source_proj=transform.source_proj and transform.source_proj.replace(transform.grid, grid),
+        target_proj=transform.target_proj and transform.target_proj.replace(transform.grid, grid),
+    )
+
+
+def reverse(transform):
+    """The transform going back the other way, from its target to its source, with the same grid."""
+    return transform._replace(
+        name=transform.target_name.split(' ')[0] + ' to ' + transform.source_name.split(' ')[0],
+        source_name=transform.target_name,
+        target_name=transform.source_name,
+        source_proj=transform.target_proj,
+        target_proj=transform.source_proj,
+        source_code=transform.target_code,
+        target_code=transform.source_code,
+    )
+
+
+def rezone(transform, zone):
+    """The same transform, but with its target in another UTM zone.
+
+    The source is left alone, so features can be read in their original zone and written
+    in the zone they actually fall in. Returns None if there's no such transform.
+    """
+    if source_zone(transform) is None:
+        return None
+    if zone == source_zone(transform):
+        return transform
+    source_code = str(transform.source_code)[:-2]
+    for candidate in transforms_for('EPSG:{}{}'.format(source_code, zone)):
+        if target_datum(candidate) == target_datum(transform) and bool(candidate.grid) == bool(transform.grid):
+            # The transform may be using a copy of the grid, so keep it
+            candidate = with_grid(candidate, transform.grid)
+            return transform._replace(
+                target_name=candidate.target_name,
+                target_proj=candidate.target_proj,
+                target_code=candidate.target_code,
+            )
+    return None
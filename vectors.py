@@ -0,0 +1,566 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ vectors
+                                 A QGIS plugin
+ This plugin uses official ICSM grids to transform between Australian coordinate systems.
+                              -------------------
+        begin                : 2017-01-08
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Alex Leith
+        email                : alex@auspatious.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+ Transforming vector files, through QGIS or straight through OGR.
+
+ Features are written with OGR in transactions. Transforms that only shift
+ coordinates with the grid shift batches of geometries as WKB in one call,
+ rather than running proj for each geometry. This isn't zero copy: OGR can
+ only write geometry objects, so each shifted buffer is still copied and
+ parsed into one. Files too big to hold in memory can be streamed a batch at
+ a time. Files that span
+ several UTM zones can be split by zone.
+"""
+
+import json
+import os
+import os.path
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import numpy as np
+
+from osgeo import gdal, ogr, osr
+
+from .coordinates import CoordinateSystem, is_grid_shift, utm_zone
+from .engine import (PROGRESS_INTERVAL, VECTOR_FORMATS, TransformError, delete_vector, gdal_wkt, log, output_format, output_size,
+                     qgis_crs, with_extension, zone_file_name, zone_transforms)
+from .timing import NO_TIMER
+from .transforms import source_zone
+from .wkb import WKBError, shift_wkb
+from qgis.core import QgsCsException, QgsFeatureRequest, QgsVectorLayer, QgsWkbTypes
+from qgis.PyQt.QtCore import Qt, QVariant
+
+# Number of features written in each transaction, for drivers that have them
+TRANSACTION_SIZE = 20000
+# Number of features read, transformed and committed together when streaming a vector file
+STREAM_BATCH_SIZE = 50000
+# Number of geometries shifted together as WKB, for transforms that are only a grid shift
+WKB_BATCH_SIZE = 1000
+
+# OGR field types for QGIS field types, anything else is written as a string
+OGR_FIELD_TYPES = {
+    QVariant.Int: ogr.OFTInteger,
+    QVariant.UInt: ogr.OFTInteger64,
+    QVariant.LongLong: ogr.OFTInteger64,
+    QVariant.ULongLong: ogr.OFTInteger64,
+    QVariant.Double: ogr.OFTReal,
+    QVariant.Bool: ogr.OFTInteger,
+    QVariant.Date: ogr.OFTDate,
+    QVariant.Time: ogr.OFTTime,
+    QVariant.DateTime: ogr.OFTDateTime,
+    QVariant.ByteArray: ogr.OFTBinary,
+}
+
+
+def ogr_geometry_type(wkb_type):
+    ogr_type = QgsWkbTypes.flatType(wkb_type)
+    if QgsWkbTypes.hasZ(wkb_type):
+        ogr_type = ogr.GT_SetZ(ogr_type)
+    if QgsWkbTypes.hasM(wkb_type):
+        ogr_type = ogr.GT_SetM(ogr_type)
+    return ogr_type
+
+
+class VectorWriter(object):
+    """Writes QGIS features with an OGR driver, in batches of TRANSACTION_SIZE features per transaction.
+
+    Drivers without transactions, such as shapefiles, just write each feature as it comes.
+    """
+
+    def __init__(self, out_file, out_format, fields, wkb_type, wkt):
+        driver = ogr.GetDriverByName(out_format.driver)
+        if driver is None:
+            raise TransformError("The {} driver isn't available in this version of GDAL".format(out_format.description))
+        if os.path.exists(out_file):
+            driver.DeleteDataSource(out_file)
+        self.dataset = driver.CreateDataSource(out_file, options=out_format.dataset_options)
+        if self.dataset is None:
+            raise TransformError("Couldn't create {}: {}".format(out_file, gdal.GetLastErrorMsg()))
+
+        srs = osr.SpatialReference(wkt)
+        if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+            srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        name = os.path.splitext(os.path.basename(out_file))[0]
+        self.layer = self.dataset.CreateLayer(name, srs, ogr_geometry_type(wkb_type), options=out_format.layer_options)
+        if self.layer is None:
+            raise TransformError("Couldn't create a layer in {}: {}".format(out_file, gdal.GetLastErrorMsg()))
+
+        # (index of the QGIS attribute, OGR type) for each field of the output, in order
+        self.fields = []
+        fid_column = self.layer.GetFIDColumn().lower()
+        for i, field in enumerate(fields):
+            if fid_column and field.name().lower() == fid_column:
+                # The driver keeps feature ids itself
+                continue
+            field_type = OGR_FIELD_TYPES.get(field.type(), ogr.OFTString)
+            field_defn = ogr.FieldDefn(field.name(), field_type)
+            if field.type() == QVariant.Bool:
+                field_defn.SetSubType(ogr.OFSTBoolean)
+            if field.length() > 0 and field_type in (ogr.OFTString, ogr.OFTReal, ogr.OFTInteger, ogr.OFTInteger64):
+                field_defn.SetWidth(field.length())
+            if field.precision() > 0 and field_type == ogr.OFTReal:
+                field_defn.SetPrecision(field.precision())
+            if self.layer.CreateField(field_defn) != 0:
+                raise TransformError("Couldn't create field {}: {}".format(field.name(), gdal.GetLastErrorMsg()))
+            self.fields.append((i, field_type))
+        self.layer_defn = self.layer.GetLayerDefn()
+
+        self.transactions = bool(self.dataset.TestCapability(ogr.ODsCTransactions))
+        self.written = 0
+        self.pending = 0
+        if self.transactions:
+            self.dataset.StartTransaction()
+
+    def _set_field(self, out_feature, index, field_type, value):
+        if value is None or (isinstance(value, QVariant) and value.isNull()):
+            out_feature.SetFieldNull(index)
+        elif field_type in (ogr.OFTDate, ogr.OFTTime, ogr.OFTDateTime):
+            if value.isNull():
+                out_feature.SetFieldNull(index)
+            else:
+                out_feature.SetField(index, value.toString(Qt.ISODate))
+        elif field_type == ogr.OFTBinary:
+            out_feature.SetFieldBinaryFromHexString(index, bytes(value).hex())
+        elif field_type == ogr.OFTString:
+            out_feature.SetField(index, str(value))
+        elif field_type == ogr.OFTReal:
+            out_feature.SetField(index, float(value))
+        else:
+            out_feature.SetField(index, int(value))
+
+    def add_feature(self, feature, wkb=None):
+        """Write a feature, with its geometry from wkb if it's given, rather than from the feature.
+
+        OGR features hold geometry objects, so the WKB is parsed into one to be written.
+        """
+        out_feature = ogr.Feature(self.layer_defn)
+        attributes = feature.attributes()
+        for index, (attribute, field_type) in enumerate(self.fields):
+            self._set_field(out_feature, index, field_type, attributes[attribute])
+        if wkb is not None:
+            out_feature.SetGeometryDirectly(ogr.CreateGeometryFromWkb(bytes(wkb)))
+        else:
+            geometry = feature.geometry()
+            if not geometry.isNull():
+                out_feature.SetGeometryDirectly(ogr.CreateGeometryFromWkb(bytes(geometry.asWkb())))
+        if self.layer.CreateFeature(out_feature) != 0:
+            raise TransformError("Error writing vector: {}".format(gdal.GetLastErrorMsg()))
+
+        self.written += 1
+        self.pending += 1
+        if self.transactions and self.pending >= TRANSACTION_SIZE:
+            self.dataset.CommitTransaction()
+            self.dataset.StartTransaction()
+            self.pending = 0
+
+    def close(self, commit=True):
+        """Finish the last transaction and close the file, which is when spatial indexes are built."""
+        if self.dataset is None:
+            return
+        if self.transactions:
+            if commit:
+                self.dataset.CommitTransaction()
+            else:
+                self.dataset.RollbackTransaction()
+        self.layer = None
+        self.layer_defn = None
+        self.dataset = None
+
+
+def _shifted_wkb(transform, geometries):
+    """The geometries as WKB bytearrays with their coordinates shifted, None for missing ones.
+
+    Each geometry is copied into a bytearray to be shifted in place, as the WKB the readers
+    return is read only. Returns None if they can't all be shifted directly, such as when a point is off the grid.
+    """
+    buffers = [bytearray(wkb) if wkb is not None else None for wkb in geometries]
+    try:
+        if shift_wkb(transform, [buffer for buffer in buffers if buffer is not None]):
+            return buffers
+    except WKBError as e:
+        log("Couldn't shift WKB directly: {}".format(e))
+    return None
+
+
+def _write_shifted(writer, transform, features, coordinate_transform):
+    """Write a batch of QGIS features, shifting their geometries as WKB where possible."""
+    buffers = _shifted_wkb(transform, [
+        None if feature.geometry().isNull() else bytes(feature.geometry().asWkb()) for feature in features])
+    for i, feature in enumerate(features):
+        if buffers is None:
+            geometry = feature.geometry()
+            if not geometry.isNull():
+                geometry.transform(coordinate_transform)
+                feature.setGeometry(geometry)
+        writer.add_feature(feature, buffers[i] if buffers else None)
+
+
+def transform_vector_file(transform, layer, out_file, progress=None, request=None, out_format=None, timer=NO_TIMER, context=None):
+    """Transform a vector layer, writing the result with the target EPSG code. Returns the name of the file written.
+
+    progress is called with the fraction complete and a message, and can return False to cancel.
+    request is an optional QgsFeatureRequest to transform only some of the features. out_format
+    is a key of VECTOR_FORMATS, and by default comes from the extension of out_file. The crs and
+    write stages are recorded by timer. context is the QgsCoordinateTransformContext to transform
+    with, as for qgis_crs. When the transform only shifts coordinates with its
+    grid, geometries are shifted as WKB in batches rather than going through proj.
+    """
+    out_format = VECTOR_FORMATS[output_format(out_file, VECTOR_FORMATS, out_format)]
+    out_file = with_extension(out_file, out_format)
+    log("Transforming file to: {} as {}".format(out_file, out_format.description))
+
+    with timer.span('crs', transform=transform.name):
+        source_crs, target_crs, dest_crs, coordinate_transform = qgis_crs(transform, context)
+        src_wkt, dst_wkt, final_wkt = gdal_wkt(transform)
+    layer.setCrs(source_crs)
+
+    cancelled = False
+    shift = is_grid_shift(transform)
+    with timer.span('write', driver=out_format.driver, features=0, wkb=shift) as span:
+        writer = VectorWriter(out_file, out_format, layer.fields(), layer.wkbType(), final_wkt or dst_wkt)
+        try:
+            if request is not None and request.filterType() == QgsFeatureRequest.FilterFids:
+                feature_count = max(len(request.filterFids()), 1)
+            else:
+                feature_count = max(layer.featureCount(), 1)
+            batch = []
+            for i, feature in enumerate(layer.getFeatures(request or QgsFeatureRequest())):
+                if shift:
+                    batch.append(feature)
+                    if len(batch) >= WKB_BATCH_SIZE:
+                        _write_shifted(writer, transform, batch, coordinate_transform)
+                        batch = []
+                else:
+                    geometry = feature.geometry()
+                    if not geometry.isNull():
+                        geometry.transform(coordinate_transform)
+                        feature.setGeometry(geometry)
+                    writer.add_feature(feature)
+                if progress and i % PROGRESS_INTERVAL == 0:
+                    if progress(float(i) / feature_count, "{} of {} features".format(i, feature_count)) is False:
+                        cancelled = True
+                        break
+            if batch and not cancelled:
+                _write_shifted(writer, transform, batch, coordinate_transform)
+            span.set(features=writer.written)
+            writer.close(commit=not cancelled)
+        except (QgsCsException, TransformError) as e:
+            writer.close(commit=False)
+            delete_vector(out_file)
+            log("Error writing vector: {}".format(e), True)
+            raise TransformError("Error writing vector: {}".format(e))
+        if not cancelled:
+            span.set(bytes=output_size(out_file))
+
+    if cancelled:
+        delete_vector(out_file)
+        raise TransformError("Transformation cancelled")
+    return out_file
+
+
+def _ogr_geometries(transform, features, coordinate_transform, shift=False):
+    """Transformed copies of the geometries of OGR features, with None for features without one.
+
+    With shift, they're shifted as WKB in one batch if they can be.
+    """
+    geometries = [feature.GetGeometryRef() for feature in features]
+    if shift:
+        buffers = _shifted_wkb(transform, [geometry.ExportToIsoWkb() if geometry is not None else None for geometry in geometries])
+        if buffers is not None:
+            return [ogr.CreateGeometryFromWkb(bytes(buffer)) if buffer is not None else None for buffer in buffers]
+    transformed = []
+    for feature, geometry in zip(features, geometries):
+        if geometry is not None:
+            geometry = geometry.Clone()
+            if geometry.Transform(coordinate_transform) != 0:
+                raise TransformError("Couldn't transform feature {}".format(feature.GetFID()))
+        transformed.append(geometry)
+    return transformed
+
+
+def checkpoint_file(out_file):
+    """Where progress streaming into an out file is recorded."""
+    return out_file + '.checkpoint'
+
+
+def _checkpoint_key(transform, in_file):
+    stat = os.stat(in_file)
+    return {'in_file': os.path.realpath(in_file), 'size': stat.st_size, 'mtime': stat.st_mtime, 'transform': transform.name,
+            'source': transform.source_code, 'target': transform.target_code}
+
+
+def read_checkpoint(transform, in_file, out_file):
+    """Whether out_file is an unfinished stream of in_file through transform, which can be resumed."""
+    try:
+        with open(checkpoint_file(out_file)) as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return os.path.exists(out_file) and checkpoint.get('key') == _checkpoint_key(transform, in_file)
+
+
+def write_checkpoint(transform, in_file, out_file):
+    path = checkpoint_file(out_file)
+    with open(path + '.part', 'w') as f:
+        json.dump({'key': _checkpoint_key(transform, in_file)}, f)
+    os.replace(path + '.part', path)
+
+
+def stream_vector_file(transform, in_file, out_file, progress=None, out_format=None, batch_size=STREAM_BATCH_SIZE, resume=True,
+                       timer=NO_TIMER):
+    """Transform a vector file too big to hold in memory, reading and writing it with OGR a batch at a time.
+
+    Each batch of batch_size features is transformed and committed in its own transaction. A
+    checkpoint file next to the output records the input and transform it's being written from.
+    If the job is interrupted, cancelled or fails, the output and checkpoint are kept, and with
+    resume a later run carries on after the features the output already holds, so a batch that
+    was committed is never written twice. The checkpoint is removed when the file is finished. Only formats with transactions, such as GeoPackage, can be streamed. When the
+    transform only shifts coordinates with its grid, geometries are shifted as WKB. Returns the
+    name of the file written.
+    """
+    out_format = VECTOR_FORMATS[output_format(out_file, VECTOR_FORMATS, out_format or 'gpkg')]
+    out_file = with_extension(out_file, out_format)
+
+    with timer.span('crs', transform=transform.name):
+        src_wkt, dst_wkt, final_wkt = gdal_wkt(transform)
+        src_srs, dst_srs, out_srs = osr.SpatialReference(src_wkt), osr.SpatialReference(dst_wkt), osr.SpatialReference(final_wkt or dst_wkt)
+        for srs in (src_srs, dst_srs, out_srs):
+            if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+                srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        coordinate_transform = osr.CoordinateTransformation(src_srs, dst_srs)
+
+    in_ds = gdal.OpenEx(in_file, gdal.OF_VECTOR | gdal.OF_READONLY)
+    if in_ds is None or in_ds.GetLayerCount() == 0:
+        raise TransformError("Couldn't read {}: {}".format(in_file, gdal.GetLastErrorMsg()))
+    in_layer = in_ds.GetLayer(0)
+    feature_count = max(in_layer.GetFeatureCount(), 1)
+
+    resuming = resume and read_checkpoint(transform, in_file, out_file)
+    driver = ogr.GetDriverByName(out_format.driver)
+    if driver is None:
+        raise TransformError("The {} driver isn't available in this version of GDAL".format(out_format.description))
+    read = 0
+    if resuming:
+        out_ds = gdal.OpenEx(out_file, gdal.OF_VECTOR | gdal.OF_UPDATE)
+        out_layer = out_ds and out_ds.GetLayer(0)
+        if out_layer is None:
+            raise TransformError("Couldn't reopen {} to resume: {}".format(out_file, gdal.GetLastErrorMsg()))
+        # Each input feature makes one output feature, and only committed batches are in the
+        # output, so it says where to carry on from even if the job stopped just after a commit
+        read = out_layer.GetFeatureCount()
+        log("Resuming {} after {} features".format(out_file, read))
+        in_layer.SetNextByIndex(read)
+    else:
+        if os.path.exists(out_file):
+            driver.DeleteDataSource(out_file)
+        out_ds = driver.CreateDataSource(out_file, options=out_format.dataset_options)
+        if out_ds is None:
+            raise TransformError("Couldn't create {}: {}".format(out_file, gdal.GetLastErrorMsg()))
+        name = os.path.splitext(os.path.basename(out_file))[0]
+        out_layer = out_ds.CreateLayer(name, out_srs, in_layer.GetGeomType(), options=out_format.layer_options)
+        if out_layer is None:
+            raise TransformError("Couldn't create a layer in {}: {}".format(out_file, gdal.GetLastErrorMsg()))
+    if not out_ds.TestCapability(ogr.ODsCTransactions):
+        out_layer = out_ds = None
+        delete_vector(out_file)
+        raise TransformError("{} files can't be streamed, use a format with transactions such as GeoPackage".format(
+            out_format.description))
+
+    # Output field for each input field, skipping one that clashes with the output's FID column
+    in_defn = in_layer.GetLayerDefn()
+    fid_column = out_layer.GetFIDColumn().lower()
+    field_map = []
+    for i in range(in_defn.GetFieldCount()):
+        field_defn = in_defn.GetFieldDefn(i)
+        if fid_column and field_defn.GetName().lower() == fid_column:
+            field_map.append(-1)
+            continue
+        if not resuming and out_layer.CreateField(field_defn) != 0:
+            raise TransformError("Couldn't create field {}: {}".format(field_defn.GetName(), gdal.GetLastErrorMsg()))
+        field_map.append(out_layer.GetLayerDefn().GetFieldIndex(field_defn.GetName()))
+    out_defn = out_layer.GetLayerDefn()
+    if not resuming:
+        write_checkpoint(transform, in_file, out_file)
+
+    cancelled = False
+    shift = is_grid_shift(transform)
+    features = iter(in_layer.GetNextFeature, None)
+    with timer.span('write', driver=out_format.driver, features=0, batches=0, resumed=read, wkb=shift) as span:
+        try:
+            while True:
+                out_ds.StartTransaction()
+                count = 0
+                while count < batch_size:
+                    # Geometries are transformed a chunk at a time, to keep memory down within big batches
+                    chunk = min(WKB_BATCH_SIZE, batch_size - count)
+                    in_features = list(islice(features, chunk))
+                    for in_feature, geometry in zip(in_features, _ogr_geometries(transform, in_features, coordinate_transform, shift)):
+                        out_feature = ogr.Feature(out_defn)
+                        out_feature.SetFromWithMap(in_feature, True, field_map)
+                        if geometry is not None:
+                            out_feature.SetGeometryDirectly(geometry)
+                        if out_layer.CreateFeature(out_feature) != 0:
+                            raise TransformError("Error writing vector: {}".format(gdal.GetLastErrorMsg()))
+                    count += len(in_features)
+                    if len(in_features) < chunk:
+                        break
+                out_ds.CommitTransaction()
+                read += count
+                span.add('features', count)
+                span.add('batches')
+                if count < batch_size:
+                    break
+                if progress and progress(float(read) / feature_count, "{} of {} features".format(read, feature_count)) is False:
+                    cancelled = True
+                    break
+        except Exception as e:
+            out_ds.RollbackTransaction()
+            out_layer = out_ds = None
+            log("Error streaming vector, {} features were committed: {}".format(read, e), True)
+            if isinstance(e, TransformError):
+                raise
+            raise TransformError("Error writing vector: {}".format(e))
+        out_layer = out_ds = None
+        if not cancelled:
+            os.remove(checkpoint_file(out_file))
+            span.set(bytes=output_size(out_file))
+
+    if cancelled:
+        log("Stopped streaming {} after {} features, run it again to resume".format(out_file, read))
+        raise TransformError("Transformation cancelled")
+    return out_file
+
+
+def zone_buckets(transform, layer, timer=NO_TIMER):
+    """The ids of the features in a layer, grouped by the UTM zone the centre of each one falls in.
+
+    Only the bounding box of each geometry is read, and the zones are worked out for all the
+    features at once. Features without a geometry stay in the source zone.
+    """
+    if source_zone(transform) is None:
+        raise TransformError("Only UTM coordinate systems can be split by zone")
+    with timer.span('zones', features=0) as span:
+        buckets = _zone_buckets(transform, layer)
+        span.set(features=sum(len(fids) for fids in buckets.values()), zones=len(buckets))
+    return buckets
+
+
+def _zone_buckets(transform, layer):
+    fids = []
+    centres = []
+    request = QgsFeatureRequest().setSubsetOfAttributes([])
+    for feature in layer.getFeatures(request):
+        geometry = feature.geometry()
+        fids.append(feature.id())
+        if geometry.isNull():
+            centres.append((np.nan, np.nan))
+        else:
+            centre = geometry.boundingBox().center()
+            centres.append((centre.x(), centre.y()))
+    if not fids:
+        return {}
+
+    fids = np.array(fids, dtype=np.int64)
+    centres = np.array(centres, dtype=np.float64)
+    lon, __ = CoordinateSystem(transform.source_proj).to_lonlat(centres[:, 0], centres[:, 1])
+    zones = np.where(np.isnan(lon), source_zone(transform), utm_zone(np.nan_to_num(lon)))
+    return dict((int(zone), fids[zones == zone].tolist()) for zone in np.unique(zones))
+
+
+def merge_zone_files(zone_files, out_file, timer=NO_TIMER):
+    """Gather per zone files into one GeoPackage, with a layer for each zone. Returns its name."""
+    with timer.span('merge', zones=len(zone_files)) as span:
+        merged = _merge_zone_files(zone_files, out_file)
+        span.set(bytes=output_size(merged))
+    return merged
+
+
+def _merge_zone_files(zone_files, out_file):
+    merged = os.path.splitext(out_file)[0] + '.gpkg'
+    if os.path.exists(merged):
+        gdal.GetDriverByName('GPKG').Delete(merged)
+    name = os.path.splitext(os.path.basename(out_file))[0]
+    for zone, zone_file in sorted(zone_files.items()):
+        options = gdal.VectorTranslateOptions(
+            format='GPKG',
+            accessMode='update' if os.path.exists(merged) else None,
+            layerName='{}_z{}'.format(name, zone),
+        )
+        if gdal.VectorTranslate(merged, zone_file, options=options) is None:
+            raise TransformError("Couldn't merge {} into {}: {}".format(zone_file, merged, gdal.GetLastErrorMsg()))
+    for zone_file in zone_files.values():
+        delete_vector(zone_file)
+    return merged
+
+
+def transform_vector_by_zone(transform, layer, out_file, merge=False, workers=None, progress=None, out_format=None,
+                             timer=NO_TIMER, context=None):
+    """Transform a vector layer that spans several UTM zones, writing each feature in the zone it falls in.
+
+    The features are bucketed by zone, and the buckets are transformed in parallel, each with
+    the matching zone's transform, into per zone files named by zone_file_name. With merge they
+    are then gathered into one GeoPackage. context is passed on to transform_vector_file.
+    Returns the list of files written.
+    """
+    buckets = zone_buckets(transform, layer, timer)
+    if not buckets:
+        raise TransformError("There are no features to transform")
+    transforms = zone_transforms(transform, buckets)
+    log("Transforming {} features in zones {}".format(
+        sum(len(fids) for fids in buckets.values()), ', '.join(str(zone) for zone in sorted(buckets))))
+
+    total = sum(len(fids) for fids in buckets.values())
+    done = dict.fromkeys(buckets, 0.0)
+
+    def zone_progress(zone):
+        def report(complete, message=None):
+            done[zone] = complete * len(buckets[zone])
+            complete = sum(done.values()) / total
+            return progress(complete, "{:.0%} complete over {} zones".format(complete, len(buckets)))
+        return report if progress else None
+
+    def run(zone):
+        # Layers can't be shared between threads, so each bucket reads its own
+        zone_layer = QgsVectorLayer(layer.source(), 'zone {}'.format(zone), layer.providerType())
+        request = QgsFeatureRequest().setFilterFids(buckets[zone])
+        return transform_vector_file(transforms[zone], zone_layer, zone_file_name(out_file, zone),
+                                     progress=zone_progress(zone), request=request, out_format=out_format, timer=timer,
+                                     context=context)
+
+    workers = max(1, min(workers or os.cpu_count() or 1, len(buckets)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = dict((zone, executor.submit(run, zone)) for zone in buckets)
+    zone_files = {}
+    errors = []
+    for zone, future in sorted(futures.items()):
+        try:
+            zone_files[zone] = future.result()
+        except TransformError as e:
+            errors.append("zone {}: {}".format(zone, e))
+    if errors:
+        for zone_file in zone_files.values():
+            delete_vector(zone_file)
+        raise TransformError("; ".join(errors))
+
+    if merge:
+        return [merge_zone_files(zone_files, out_file, timer)]
+    return [zone_files[zone] for zone in sorted(zone_files)]
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+/***************************************************************************
+ wkb
+                                 A QGIS plugin
+ This plugin uses official ICSM grids to transform between Australian coordinate systems.
+                              -------------------
+        begin                : 2017-01-08
+        git sha              : $Format:%H$
+        copyright            : (C) 2017 by Alex Leith
+        email                : alex@auspatious.com
+ ***************************************************************************/
+
+/***************************************************************************
+ *                                                                         *
+ *   This program is free software; you can redistribute it and/or modify  *
+ *   it under the terms of the GNU General Public License as published by  *
+ *   the Free Software Foundation; either version 2 of the License, or     *
+ *   (at your option) any later version.                                   *
+ *                                                                         *
+ ***************************************************************************/
+ Shifting the coordinates of WKB geometries in place.
+
+ A datum shift moves every vertex but leaves the structure of a geometry
+ alone, so there's no need to build geometry objects for it. The WKB is
+ walked once to find its runs of coordinates, NumPy arrays are laid over
+ those runs without copying, and the vertices of a whole batch of
+ geometries are shifted in one call. The buffers have to be writable, so
+ callers copy read only WKB into bytearrays first. Both ISO and extended
+ (PostGIS style) WKB are read, in either byte order. Nothing here needs QGIS.
+"""
+
+import struct
+
+import numpy as np
+
+from .coordinates import transform_coordinates
+
+# Extended WKB flags
+EWKB_Z = 0x80000000
+EWKB_M = 0x40000000
+EWKB_SRID = 0x20000000
+
+POINT = 1
+# Geometry types that are a single run of points
+CURVES = (2, 8)  # LineString, CircularString
+# Geometry types that are a count of rings, each a run of points
+SURFACES = (3, 17)  # Polygon, Triangle
+# Geometry types that are a count of geometries, each with its own header
+COLLECTIONS = (4, 5, 6, 7, 9, 10, 11, 12, 15, 16)
+
+
+class WKBError(ValueError):
+    """Raised when a geometry can't be read as WKB."""
+
+
+def _read(buffer, offset, runs):
+    """Add the (offset, points, dimensions, dtype) runs of the geometry at offset to runs, and return where it ends."""
+    if offset + 5 > len(buffer):
+        raise WKBError("WKB ends early at byte {}".format(offset))
+    endian = '<' if buffer[offset] == 1 else '>'
+    uint = struct.Struct(endian + 'I')
+    geometry_type = uint.unpack_from(buffer, offset + 1)[0]
+    offset += 5
+
+    has_z = bool(geometry_type & EWKB_Z)
+    has_m = bool(geometry_type & EWKB_M)
+    if geometry_type & EWKB_SRID:
+        offset += 4
+    geometry_type &= 0x0fffffff
+    has_z = has_z or geometry_type // 1000 in (1, 3)
+    has_m = has_m or geometry_type // 1000 in (2, 3)
+    geometry_type %= 1000
+    dimensions = 2 + has_z + has_m
+    dtype = endian + 'f8'
+
+    if geometry_type == POINT:
+        runs.append((offset, 1, dimensions, dtype))
+        return offset + 8 * dimensions
+    if geometry_type in CURVES:
+        points = uint.unpack_from(buffer, offset)[0]
+        runs.append((offset + 4, points, dimensions, dtype))
+        return offset + 4 + 8 * dimensions * points
+    if geometry_type in SURFACES:
+        rings = uint.unpack_from(buffer, offset)[0]
+        offset += 4
+        for __ in range(rings):
+            points = uint.unpack_from(buffer, offset)[0]
+            runs.append((offset + 4, points, dimensions, dtype))
+            offset += 4 + 8 * dimensions * points
+        return offset
+    if geometry_type in COLLECTIONS:
+        parts = uint.unpack_from(buffer, offset)[0]
+        offset += 4
+        for __ in range(parts):
+            offset = _read(buffer, offset, runs)
+        return offset
+    raise WKBError("Unsupported WKB geometry type {}".format(geometry_type))
+
+
+def coordinate_runs(buffer):
+    """The runs of coordinates in a WKB geometry, as (offset, points, dimensions, dtype)."""
+    runs = []
+    try:
+        end = _read(buffer, 0, runs)
+    except struct.error as e:
+        raise WKBError(str(e))
+    if end > len(buffer):
+        raise WKBError("WKB ends early, {} of {} bytes".format(len(buffer), end))
+    return runs
+
+
+def coordinate_views(buffer):
+    """Writable (points, dimensions) arrays over the coordinates of a WKB geometry in a bytearray."""
+    return [np.frombuffer(buffer, dtype=dtype, count=points * dimensions, offset=offset).reshape(points, dimensions)
+            for offset, points, dimensions, dtype in coordinate_runs(buffer) if points]
+
+
+def shift_wkb(transform, buffers):
+    """Transform the x and y of WKB geometries in bytearrays in place, all in one batch.
+
+    Z and M values are left alone. Returns False, without changing anything, if any point is
+    outside the transform's grid, so the caller can fall back to transforming them another way.
+    """
+    views = [view for buffer in buffers for view in coordinate_views(buffer)]
+    if not views:
+        return True
+    points = np.concatenate([view[:, :2] for view in views])
+    x, y = transform_coordinates(transform, points[:, 0], points[:, 1])
+    if np.isnan(x[~np.isnan(points[:, 0])]).any():
+        return False
+    start = 0
+    for view in views:
+        end = start + len(view)
+        view[:, 0] = x[start:end]
+        view[:, 1] = y[start:end]
+        start = end
+    return True